@@ -3,36 +3,109 @@
 from __future__ import print_function, division, absolute_import, unicode_literals
 import numpy as np
 from .spectrum import Spectrum
-from .spectrum_utils import take_closest, binary_search_mz_values
+from .spectrum_utils import take_closest, binary_search_mz_values, PreprocessorMixin, find_mz_partition_boundaries
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from shutil import rmtree
 from subprocess import call
-from os.path import join
-from os import remove
+from tempfile import mkdtemp
+from os.path import abspath, join
 
 
 
-class Mass_Spectra_Aligner():
+class Mass_Spectra_Aligner(PreprocessorMixin):
 
     def __init__(self, window_size=10):
         self.window_size = window_size
         self.reference_mz = []
 
-    def fit(self, spectra):
-        self._train(spectra)
+    def fit(self, spectra, n_jobs=1):
+        """
+        Find the alignment points of a set of spectra.
+        :param spectra: A set of spectrum object.
+        :param n_jobs: The number of alignment programs run in parallel, each one in a different m/z range. None=one
+                       per CPU.
+        """
+        self._train(spectra, n_jobs=n_jobs)
 
-    def _train(self, spectra):
+    def _train(self, spectra, n_jobs=1):
         """
         Fill the reference_mz attribute with possible m/z values.
         :param spectra: A set of spectrum object.
+        :param n_jobs: The number of alignment programs run in parallel.
         :return: Nothing
         """
         path = "tutorial_code/cpp_extensions"
-        self._write_mz_values_to_file(spectra, path)
+        program = abspath(join(path, "alignment"))
 
-        call([str(join(path, "alignment")),
-                  "temp_spectra.csv",
-                  str(self.window_size)])
+        if n_jobs is None:
+            n_jobs = cpu_count()
+        partitions = self._partition_mz_values([s.mz_values for s in spectra], n_jobs)
 
-        self.reference_mz = self._read_reference_from_file(path)
+        if len(partitions) == 1:
+            partition_reference_mz = [self._find_alignment_points(program, *partitions[0])]
+        else:
+            # The program runs outside of Python, so threads are enough to run several instances at once
+            pool = ThreadPool(processes=min(n_jobs, len(partitions)))
+            try:
+                partition_reference_mz = pool.map(lambda partition: self._find_alignment_points(program, *partition),
+                                                  partitions, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+
+        # The alignment points of different partitions are more than a window apart, so the overlap rejection done by
+        # the program within each partition is the same as over the whole m/z range
+        self.reference_mz = np.concatenate(partition_reference_mz)
+
+    def _partition_mz_values(self, spectra_mz_values, n_partitions):
+        """
+        Splits the m/z values of the spectra into m/z ranges that can be aligned independently.
+        :param spectra_mz_values: The sorted m/z values of each spectrum.
+        :param n_partitions: The desired number of partitions.
+        :return: A list of (spectra_mz_values, next_mz) tuples, where next_mz is the first m/z value of the next
+                 partition (None for the last partition).
+        """
+        all_mz_values = np.sort(np.concatenate(spectra_mz_values))
+        boundaries = find_mz_partition_boundaries(all_mz_values, n_partitions, self.window_size / 1000000.0)
+        boundary_mz = [all_mz_values[0]] + [all_mz_values[b] for b in boundaries] + [None]
+
+        partitions = []
+        for start_mz, next_mz in zip(boundary_mz[:-1], boundary_mz[1:]):
+            partition_mz_values = []
+            for mz_values in spectra_mz_values:
+                start = np.searchsorted(mz_values, start_mz, side="left")
+                stop = np.searchsorted(mz_values, next_mz, side="left") if next_mz is not None else len(mz_values)
+                if stop > start:
+                    partition_mz_values.append(mz_values[start:stop])
+            partitions.append((partition_mz_values, next_mz))
+        return partitions
+
+    def _find_alignment_points(self, program, spectra_mz_values, next_mz=None):
+        """
+        Runs the alignment program on a set of spectra in a temporary directory.
+        :param program: The path to the alignment program.
+        :param spectra_mz_values: The m/z values of each spectrum.
+        :param next_mz: If not None, the first m/z value after the m/z range of the spectra.
+        :return: The alignment points.
+        """
+        if next_mz is not None:
+            # The program handles the end of its input differently from a gap in the middle of it. Adding the next
+            # peak makes it process the last peaks of the range exactly as in a single run over all the m/z values.
+            # This peak is alone in its window and always yields the last alignment point, which is discarded.
+            spectra_mz_values = spectra_mz_values + [np.array([next_mz])]
+
+        path = mkdtemp()
+        try:
+            self._write_mz_values_to_file(spectra_mz_values, path)
+            call([program, "temp_spectra.csv", str(self.window_size)], cwd=path)
+            reference_mz = self._read_reference_from_file(path)
+        finally:
+            rmtree(path)
+
+        if next_mz is not None:
+            reference_mz = reference_mz[:-1]
+        return reference_mz
 
     def transform(self, spectra):
         new_spectra = []
@@ -70,15 +143,15 @@ class Mass_Spectra_Aligner():
                 nf_int.append(spec.intensity_values[i])
 
         return Spectrum(np.asarray(aligned_mz), np.asarray(aligned_int),
-                        spec.mz_precision, spec.metadata)
+                        spec.mz_precision, spec.metadata, storage=spec.storage)
 
-    def _write_mz_values_to_file(self, spectra, path):
-        filename = "temp_spectra.csv"
+    def _write_mz_values_to_file(self, spectra_mz_values, path):
+        filename = join(path, "temp_spectra.csv")
         f = open(filename,"w")
 
-        for s in spectra:
+        for mz_values in spectra_mz_values:
             line = ""
-            for mz in s.mz_values:
+            for mz in mz_values:
                 line += str(mz)
                 line += ","
             line = line[:-1]
@@ -88,16 +161,15 @@ class Mass_Spectra_Aligner():
         f.close()
 
     def _read_reference_from_file(self, path):
-        filename = "alignmentPoints.txt"
+        filename = join(path, "alignmentPoints.txt")
 
         f = open(filename,"r")
         line = f.readline().strip().split(" ")
+        f.close()
 
         mz_values = []
         for mz in line:
-            mz_values.append(round(float(mz),4))
+            if mz:
+                mz_values.append(round(float(mz),4))
 
-        #clear temporary files
-        #remove("temp_spectra.csv")
-        #remove(filename)
-        return np.asarray(mz_values)
\ No newline at end of file
+        return np.asarray(mz_values)
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division, absolute_import, unicode_literals
+import numpy as np
+from timeit import default_timer
+from .spectrum import _sort_and_merge_peaks
+from .spectrum_utils import find_closest_values, find_closest_values_in_window
+
+class SpectrumCorrectionApplier(object):
+    """
+    Applies a fitted VirtualLockMassCorrector and/or Mass_Spectra_Aligner to a single spectrum given as a pair of m/z
+    and intensity arrays. No Spectrum objects are built and all the operations are vectorized, which makes it suitable
+    for correcting spectra as they are acquired.
+
+    The results are the same as those of the transform methods of the corrector and the aligner, applied to a Spectrum
+    built from the same arrays.
+    """
+
+    def __init__(self, vlm_corrector=None, aligner=None, threshold=None, mz_precision=4):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        vlm_corrector: VirtualLockMassCorrector, default=None
+                       A fitted VLM corrector. If None, no VLM correction is applied.
+
+        aligner: Mass_Spectra_Aligner, default=None
+                 A fitted aligner. If None, no alignment is applied.
+
+        threshold: float, default=None
+                   If not None, the peaks that have an intensity value less or equal to this threshold are removed
+                   before the correction (see ThresholdedPeakFiltering).
+
+        mz_precision: int, default=4
+                      The m/z precision (in decimals) of the spectra.
+        """
+        self.threshold = threshold
+        self.mz_precision = mz_precision
+
+        self._vlm_mz = None
+        if vlm_corrector is not None:
+            if vlm_corrector._vlm_mz is None:
+                raise RuntimeError("The VLM corrector must be fitted before applying a correction.")
+            if len(vlm_corrector._vlm_mz) <= 2:
+                raise ValueError("There must be at least 3 points to use virtual lock-mass")
+            if vlm_corrector.mode != 'flat':
+                raise NotImplementedError("Use flat mode.")
+            if vlm_corrector.polynomial_degree != 1:
+                raise NotImplementedError("Only linear corrections (poly_degree=1) are supported.")
+            self._vlm_mz = np.array(vlm_corrector._vlm_mz, dtype=np.float64)
+            self._vlm_window_size_ppm = vlm_corrector.window_size_ppm
+            self._vlm_minimum_peak_intensity = vlm_corrector.minimum_peak_intensity
+            self._vlm_max_skipped_points = vlm_corrector.max_skipped_points
+
+        self._reference_mz = None
+        if aligner is not None:
+            if len(aligner.reference_mz) == 0:
+                raise RuntimeError("The aligner must be fitted before applying an alignment.")
+            self._reference_mz = np.sort(np.asarray(aligner.reference_mz, dtype=np.float64))
+            self._alignment_window_size = float(aligner.window_size)
+
+    def correct(self, mz_values, intensity_values):
+        """
+        Applies the VLM correction (see VirtualLockMassCorrector.transform).
+
+        Note: assumes that the m/z values are sorted, unique and rounded to mz_precision.
+        """
+        observed_mz = mz_values[intensity_values > self._vlm_minimum_peak_intensity]
+        if len(observed_mz) == 0:
+            raise ValueError("There is no value in vlock_mass or observed_mz")
+
+        # Closest peak to each VLM. Ties go to the smallest m/z (see take_closest_lo)
+        best_match = find_closest_values(observed_mz, self._vlm_mz)
+
+        found = np.abs(best_match - self._vlm_mz) <= self._vlm_mz * self._vlm_window_size_ppm
+        if self._vlm_max_skipped_points is not None and \
+                np.count_nonzero(~found) > self._vlm_max_skipped_points:
+            raise ValueError("A VLM was not found in the appropriate window")
+        if not found.any():
+            raise ValueError("There is no value in vlock_mass or observed_mz")
+        observed_mz = best_match[found]
+        correction_ratios = self._vlm_mz[found] / observed_mz
+
+        # Flat correction before the first and after the last VLM, linear in between
+        segment = np.searchsorted(observed_mz, mz_values, side="right") - 1
+        inside = (segment >= 0) & (segment < len(observed_mz) - 1)
+        ratios = np.where(segment < 0, correction_ratios[0], correction_ratios[-1])
+        segment = segment[inside]
+        slopes = (correction_ratios[segment + 1] - correction_ratios[segment]) / \
+                 (observed_mz[segment + 1] - observed_mz[segment])
+        intercepts = correction_ratios[segment + 1] - slopes * observed_mz[segment + 1]
+        ratios[inside] = slopes * mz_values[inside] + intercepts
+
+        return _sort_and_merge_peaks(mz_values * ratios, intensity_values, self.mz_precision)
+
+    def align(self, mz_values, intensity_values):
+        """
+        Moves each peak to the closest alignment point in its window (see Mass_Spectra_Aligner.transform).
+
+        Note: assumes that the m/z values are sorted, unique and rounded to mz_precision.
+        """
+        closest_mz = find_closest_values_in_window(self._reference_mz, mz_values, self._alignment_window_size)
+        aligned_mz = np.where(np.isnan(closest_mz), mz_values, closest_mz)
+
+        return _sort_and_merge_peaks(aligned_mz, intensity_values, self.mz_precision)
+
+    def __call__(self, mz_values, intensity_values):
+        """
+        Corrects and aligns a spectrum.
+
+        Parameters
+        ----------
+        mz_values: array-like, dtype=float, shape=n_peaks
+            The m/z values of the peaks. They do not need to be sorted.
+
+        intensity_values: array-like, dtype=float, shape=n_peaks
+            The intensity values of the peaks.
+
+        Returns
+        -------
+        mz_values: array-like, dtype=float
+            The sorted m/z values of the corrected spectrum.
+
+        intensity_values: array-like, dtype=float
+            The intensity values of the corrected spectrum.
+        """
+        mz_values, intensity_values = _sort_and_merge_peaks(mz_values, intensity_values, self.mz_precision)
+        if self.threshold is not None:
+            keep_mask = intensity_values > self.threshold
+            mz_values = mz_values[keep_mask]
+            intensity_values = intensity_values[keep_mask]
+        if self._vlm_mz is not None:
+            mz_values, intensity_values = self.correct(mz_values, intensity_values)
+        if self._reference_mz is not None:
+            mz_values, intensity_values = self.align(mz_values, intensity_values)
+        return mz_values, intensity_values
+
+def benchmark_latency(applier, spectra, n_repeats=10):
+    """
+    Measures the time taken by an applier to process individual spectra.
+
+    Parameters
+    ----------
+    applier: SpectrumCorrectionApplier
+        The applier.
+
+    spectra: list of (array-like, array-like)
+        The (mz_values, intensity_values) pairs of the spectra to process.
+
+    n_repeats: int, default=10
+        The number of times each spectrum is processed.
+
+    Returns
+    -------
+    latencies: dict
+        The "mean", "median", "p99" and "max" latency per spectrum, in seconds.
+    """
+    latencies = []
+    for _ in range(n_repeats):
+        for mz_values, intensity_values in spectra:
+            start = default_timer()
+            applier(mz_values, intensity_values)
+            latencies.append(default_timer() - start)
+    latencies = np.array(latencies)
+    return {"mean": latencies.mean(),
+            "median": np.median(latencies),
+            "p99": np.percentile(latencies, 99),
+            "max": latencies.max()}
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Command-line entry point for batch pre-processing of HDF5 spectra files.
+
+Usage (from the directory containing tutorial_code):
+
+    python -m tutorial_code --config config.json --output processed.h5 --jobs 4 run1.h5 run2.h5 ...
+
+The configuration is a JSON file. All the keys are optional:
+
+    {
+        "threshold": 250,
+        "vlm": {"window_size": 40, "minimum_peak_intensity": 1000},
+        "alignment": {"window_size": 30},
+        "fit_sample_size": 80,
+        "storage": "compact",
+        "random_state": 42
+    }
+
+Setting "vlm" or "alignment" to null skips the corresponding step. The pre-processors are fitted on a random sample of
+fit_sample_size spectra (default: 100) drawn across all the files, so that the fitting spectra fit in memory however
+many files are processed.
+"""
+
+from __future__ import print_function, division, absolute_import, unicode_literals
+import argparse
+import json
+import sys
+import time
+
+# Note: the pre-processing modules import numpy and h5py. They are only imported once the arguments have been parsed,
+# so that --help and invalid invocations return immediately.
+
+DEFAULT_CONFIG = {
+    "threshold": 250,
+    "vlm": {"window_size": 40, "minimum_peak_intensity": 1000},
+    "alignment": {"window_size": 30},
+    "fit_sample_size": 100,
+    "storage": "default",
+    "random_state": None
+}
+
+def load_config(config_file=None):
+    """
+    Loads a configuration file and completes it with the default values.
+
+    Parameters
+    ----------
+    config_file: str, default=None
+        The path to a JSON configuration file. If None, the default configuration is returned.
+
+    Returns
+    -------
+    config: dict
+        The configuration.
+    """
+    config = dict(DEFAULT_CONFIG)
+    if config_file is not None:
+        with open(config_file, "r") as f:
+            user_config = json.load(f)
+        unknown_keys = set(user_config) - set(DEFAULT_CONFIG)
+        if unknown_keys:
+            raise ValueError("Unknown configuration keys: %s" % ", ".join(sorted(unknown_keys)))
+        config.update(user_config)
+    if not isinstance(config["fit_sample_size"], int) or config["fit_sample_size"] < 1:
+        raise ValueError("fit_sample_size must be a positive number of spectra.")
+    return config
+
+def build_preprocessors(config):
+    """
+    Creates the chain of pre-processors described by a configuration.
+
+    Parameters
+    ----------
+    config: dict
+        The configuration (see load_config).
+
+    Returns
+    -------
+    preprocessors: list of pre-processors
+        The unfitted pre-processors, in the order in which they must be applied.
+    """
+    from .spectrum_utils import ThresholdedPeakFiltering
+
+    preprocessors = [ThresholdedPeakFiltering(threshold=config["threshold"])]
+    if config["vlm"] is not None:
+        from .virtual_lock_mass import VirtualLockMassCorrector
+        preprocessors.append(VirtualLockMassCorrector(**config["vlm"]))
+    if config["alignment"] is not None:
+        from .alignment import Mass_Spectra_Aligner
+        preprocessors.append(Mass_Spectra_Aligner(**config["alignment"]))
+    return preprocessors
+
+def _get_storage(name):
+    from . import spectrum
+    storages = {"default": spectrum.DEFAULT_STORAGE,
+                "compact": spectrum.COMPACT_STORAGE,
+                "fixed_point": spectrum.FIXED_POINT_STORAGE,
+                "counts": spectrum.COUNTS_STORAGE}
+    if name not in storages:
+        raise ValueError("Unknown storage mode: %s. Use one of %s." % (name, ", ".join(sorted(storages))))
+    return storages[name]
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(prog="python -m tutorial_code",
+                                     description="Threshold, correct (VLM) and align HDF5 spectra files.")
+    parser.add_argument("files", nargs="+", help="The HDF5 spectra files to process.")
+    parser.add_argument("--config", default=None, help="A JSON configuration file.")
+    parser.add_argument("--output", required=True, help="The HDF5 file where the processed spectra are saved.")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="The number of worker processes. 0 uses one worker per CPU. Default: 1.")
+    parser.add_argument("--chunk-size", type=int, default=None,
+                        help="Read and process the files by chunks of this many spectra, prefetching the next chunks "
+                             "in the background. Default: load each file at once.")
+    parser.add_argument("--quiet", action="store_true", help="Do not report progress.")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    """
+    Runs the pre-processing pipeline from the command line.
+
+    Parameters
+    ----------
+    argv: list of str, default=None
+        The command-line arguments. If None, sys.argv is used.
+
+    Returns
+    -------
+    status: int
+        The exit status.
+    """
+    args = _parse_args(argv)
+    config = load_config(args.config)
+
+    def report(message):
+        if not args.quiet:
+            print(message, file=sys.stderr)
+
+    def progress(n_processed, n_files):
+        report("Processed %d/%d files (%.1f s)" % (n_processed, n_files, time.time() - start_time))
+
+    start_time = time.time()
+
+    from .dataset import SpectraDataset, process_dataset
+
+    dataset = SpectraDataset(args.files, storage=_get_storage(config["storage"]))
+    preprocessors = build_preprocessors(config)
+
+    report("Fitting the pre-processors on a sample of %d spectra..." % config["fit_sample_size"])
+
+    spectra = process_dataset(dataset, preprocessors, fit_sample_size=config["fit_sample_size"],
+                              n_jobs=args.jobs if args.jobs > 0 else None, output_file=args.output,
+                              random_state=config["random_state"], progress=progress,
+                              chunk_size=args.chunk_size)
+
+    report("Done: %d spectra processed in %.1f s" % (len(spectra), time.time() - start_time))
+    return 0
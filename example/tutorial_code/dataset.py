@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division, absolute_import, unicode_literals
+import numpy as np
+from multiprocessing import Pool, cpu_count
+from .spectrum_io import hdf5_load, hdf5_save, hdf5_spectra_count, HDF5ChunkReader
+
+class SpectraDataset(object):
+    """
+    A dataset made of several HDF5 spectra files (e.g.: one file per acquisition run). Each file is a shard that can be
+    loaded and processed independently of the others.
+    """
+
+    def __init__(self, file_names, metadata=True, storage=None):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        file_names: list of str
+                    The paths to the HDF5 files of the dataset.
+
+        metadata: bool, default=True
+                  Specifies if the metadata should be loaded along with the spectra.
+
+        storage: StorageMode, default=None
+                 The storage mode of the loaded spectra. If None, the default storage mode is used.
+        """
+        self.file_names = list(file_names)
+        self.metadata = metadata
+        self.storage = storage
+
+    def __len__(self):
+        return len(self.file_names)
+
+    def load_shard(self, index):
+        """
+        Loads the spectra of a shard.
+
+        Parameters
+        ----------
+        index: int
+            The index of the shard in the dataset.
+
+        Returns
+        -------
+        spectra: list of Spectrum
+            The spectra contained in the shard.
+        """
+        return hdf5_load(self.file_names[index], metadata=self.metadata, storage=self.storage)
+
+    def iter_shard_chunks(self, index, chunk_size, prefetch=2):
+        """
+        Iterates over the spectra of a shard by chunks. The next chunks are read on a background thread while the
+        current chunk is being processed.
+
+        Parameters
+        ----------
+        index: int
+            The index of the shard in the dataset.
+
+        chunk_size: int
+            The number of spectra in each chunk.
+
+        prefetch: int, default=2
+            The maximum number of chunks that are read in advance.
+
+        Returns
+        -------
+        chunks: iterator of list of Spectrum
+            An iterator over the chunks of spectra contained in the shard.
+        """
+        return iter(HDF5ChunkReader(self.file_names[index], chunk_size=chunk_size, prefetch=prefetch,
+                                    metadata=self.metadata, storage=self.storage))
+
+    def sample(self, n_spectra, random_state=None):
+        """
+        Loads a random sample of spectra drawn uniformly across all the shards. Only the sampled spectra are read.
+
+        Parameters
+        ----------
+        n_spectra: int
+            The number of spectra to sample. If it exceeds the size of the dataset, all the spectra are returned.
+
+        random_state: int or np.random.RandomState, default=None
+            The seed or the random number generator used for sampling.
+
+        Returns
+        -------
+        spectra: list of Spectrum
+            The sampled spectra.
+        """
+        if not isinstance(random_state, np.random.RandomState):
+            random_state = np.random.RandomState(random_state)
+
+        shard_sizes = np.array([hdf5_spectra_count(file_name) for file_name in self.file_names], dtype=np.int64)
+        n_spectra = min(n_spectra, shard_sizes.sum())
+        sampled_idx = np.sort(random_state.choice(shard_sizes.sum(), size=n_spectra, replace=False))
+
+        shard_starts = np.concatenate(([0], np.cumsum(shard_sizes)))
+        sampled_shards = np.searchsorted(shard_starts, sampled_idx, side="right") - 1
+
+        spectra = []
+        for shard in np.unique(sampled_shards):
+            shard_idx = sampled_idx[sampled_shards == shard] - shard_starts[shard]
+            spectra += hdf5_load(self.file_names[shard], metadata=self.metadata, indices=shard_idx,
+                                 storage=self.storage)
+        return spectra
+
+def fit_preprocessors(preprocessors, spectra):
+    """
+    Fits a chain of pre-processors. Each pre-processor is fitted on the spectra transformed by the previous ones.
+
+    Parameters
+    ----------
+    preprocessors: list of pre-processors
+        The pre-processors to fit (e.g.: ThresholdedPeakFiltering, VirtualLockMassCorrector, Mass_Spectra_Aligner), in
+        the order in which they must be applied.
+
+    spectra: list of Spectrum
+        The training spectra.
+
+    Returns
+    -------
+    preprocessors: list of pre-processors
+        The fitted pre-processors.
+    """
+    for preprocessor in preprocessors:
+        preprocessor.fit(spectra)
+        spectra = preprocessor.transform(spectra)
+    return preprocessors
+
+def apply_preprocessors(preprocessors, spectra):
+    """
+    Applies a chain of fitted pre-processors to a list of spectra.
+
+    Parameters
+    ----------
+    preprocessors: list of pre-processors
+        The fitted pre-processors, in the order in which they must be applied.
+
+    spectra: list of Spectrum
+        The spectra to transform.
+
+    Returns
+    -------
+    transformed_spectra: list of Spectrum
+        The transformed spectra.
+    """
+    for preprocessor in preprocessors:
+        spectra = preprocessor.transform(spectra)
+    return list(spectra)
+
+def _process_shard(dataset, index, preprocessors, chunk_size):
+    if chunk_size is None:
+        return apply_preprocessors(preprocessors, dataset.load_shard(index))
+
+    shard_spectra = []
+    for spectra in dataset.iter_shard_chunks(index, chunk_size):
+        shard_spectra += apply_preprocessors(preprocessors, spectra)
+    return shard_spectra
+
+# The fitted pre-processors are sent once to each worker process rather than with every shard
+_worker_preprocessors = None
+_worker_dataset = None
+_worker_chunk_size = None
+
+def _init_worker(preprocessors, dataset, chunk_size):
+    global _worker_preprocessors, _worker_dataset, _worker_chunk_size
+    _worker_preprocessors = preprocessors
+    _worker_dataset = dataset
+    _worker_chunk_size = chunk_size
+
+def _process_worker_shard(index):
+    return _process_shard(_worker_dataset, index, _worker_preprocessors, _worker_chunk_size)
+
+def process_dataset(dataset, preprocessors, fit_sample_size=None, n_jobs=1, output_file=None, random_state=None,
+                    progress=None, chunk_size=None):
+    """
+    Applies a chain of pre-processors to every shard of a dataset. The pre-processors are fitted once on a sample of
+    the dataset and the shards are then transformed in parallel.
+
+    Parameters
+    ----------
+    dataset: SpectraDataset
+        The dataset to process.
+
+    preprocessors: list of pre-processors
+        The pre-processors to apply (e.g.: ThresholdedPeakFiltering, VirtualLockMassCorrector, Mass_Spectra_Aligner),
+        in the order in which they must be applied.
+
+    fit_sample_size: int, default=None
+        The number of spectra sampled to fit the pre-processors. If None, the pre-processors are assumed to be
+        already fitted.
+
+    n_jobs: int, default=1
+        The number of worker processes. If None, one worker per CPU is used.
+
+    output_file: str, default=None
+        The path of a HDF5 file where the processed spectra are saved. If None, nothing is written.
+
+    random_state: int or np.random.RandomState, default=None
+        The seed or the random number generator used for sampling the fitting spectra.
+
+    progress: callable, default=None
+        A function called as progress(n_processed_shards, n_shards) every time a shard has been processed.
+
+    chunk_size: int, default=None
+        If not None, the shards are read and transformed by chunks of chunk_size spectra. The next chunks are read on a
+        background thread while the current chunk is being transformed. If None, each shard is loaded at once.
+
+    Returns
+    -------
+    spectra: list of Spectrum
+        The processed spectra of all the shards, in the order of the shards.
+    """
+    if fit_sample_size is not None:
+        fit_preprocessors(preprocessors, dataset.sample(fit_sample_size, random_state=random_state))
+
+    if n_jobs is None:
+        n_jobs = cpu_count()
+
+    shard_results = []
+    if n_jobs == 1:
+        for i in range(len(dataset)):
+            shard_results.append(_process_shard(dataset, i, preprocessors, chunk_size))
+            if progress is not None:
+                progress(len(shard_results), len(dataset))
+    else:
+        pool = Pool(processes=min(n_jobs, len(dataset)), initializer=_init_worker,
+                    initargs=(preprocessors, dataset, chunk_size))
+        try:
+            for shard_spectra in pool.imap(_process_worker_shard, range(len(dataset)), chunksize=1):
+                shard_results.append(shard_spectra)
+                if progress is not None:
+                    progress(len(shard_results), len(dataset))
+        finally:
+            pool.close()
+            pool.join()
+
+    spectra = [spectrum for shard_spectra in shard_results for spectrum in shard_spectra]
+
+    if output_file is not None:
+        hdf5_save(output_file, spectra)
+
+    return spectra
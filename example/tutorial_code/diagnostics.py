@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Quality diagnostics of the virtual lock mass correction and of the alignment. The statistics of a whole batch of spectra
+are computed at once on their concatenated peaks, without looping over the spectra, so that they can be monitored on
+every batch (e.g.: to detect instrument drift).
+
+Example:
+--------
+vlm_report = vlm_diagnostics(corrector, spectra, region_edges=[0, 500, 1000, 2000])
+spectra = corrector.transform(spectra)
+alignment_report = alignment_diagnostics(aligner, spectra)
+"""
+
+from __future__ import print_function, division, absolute_import, unicode_literals
+import numpy as np
+from .spectrum_io import _concatenate_peaks
+from .spectrum_utils import find_closest_values, find_closest_values_in_window
+
+def _group_statistics(values, groups, n_groups):
+    """
+    Computes the number of values, the mean value and the maximum absolute value of each group. NaN values are ignored.
+    The mean and the maximum are NaN for empty groups.
+    """
+    is_valid = ~np.isnan(values)
+    values = values[is_valid]
+    groups = groups[is_valid]
+
+    counts = np.bincount(groups, minlength=n_groups)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.bincount(groups, weights=values, minlength=n_groups) / counts
+    max_abs = np.full(n_groups, np.nan)
+    if len(values) > 0:
+        max_abs[:] = 0.0
+        np.maximum.at(max_abs, groups, np.abs(values))
+        max_abs[counts == 0] = np.nan
+    return counts, means, max_abs
+
+def _region_indices(mz_values, region_edges):
+    """
+    Returns the region of each m/z value (-1 if it is outside of the regions).
+    """
+    regions = np.searchsorted(region_edges, mz_values, side="right") - 1
+    regions[regions >= len(region_edges) - 1] = -1
+    return regions
+
+def _add_region_statistics(report, prefix, values, spectrum_ids, mz_values, region_edges, n_spectra):
+    region_edges = np.asarray(region_edges, dtype=np.float64)
+    n_regions = len(region_edges) - 1
+    regions = _region_indices(mz_values, region_edges)
+    in_region = regions >= 0
+    counts, means, max_abs = _group_statistics(values[in_region],
+                                               spectrum_ids[in_region] * n_regions + regions[in_region],
+                                               n_spectra * n_regions)
+    report["region_edges"] = region_edges
+    report["region_" + prefix + "_count"] = counts.reshape(n_spectra, n_regions)
+    report["region_mean_" + prefix] = means.reshape(n_spectra, n_regions)
+    report["region_max_abs_" + prefix] = max_abs.reshape(n_spectra, n_regions)
+
+def vlm_diagnostics(corrector, spectra, region_edges=None):
+    """
+    Measures how the virtual lock masses (VLM) are found in spectra, before they are corrected.
+
+    Parameters
+    ----------
+    corrector: VirtualLockMassCorrector
+        A fitted VLM corrector.
+
+    spectra: list of Spectrum
+        The spectra, before the correction.
+
+    region_edges: array-like, default=None
+        The sorted m/z boundaries of the regions in which the statistics are also computed. Region i contains the m/z
+        values in [region_edges[i], region_edges[i + 1]). If None, no region statistics are computed.
+
+    Returns
+    -------
+    report: dict
+        * "vlm_mz": the m/z values of the VLMs, shape=(n_vlm,).
+        * "shift_ppm": the shift of the peak matched to each VLM in each spectrum, (observed m/z - VLM m/z) / VLM m/z
+          in ppm, shape=(n_spectra, n_vlm). NaN where the VLM is not found in its window. The correction moves the
+          peaks by the opposite of this shift.
+        * "n_found": the number of VLMs found in each spectrum, shape=(n_spectra,).
+        * "hit_rate": the fraction of the VLMs found in each spectrum, shape=(n_spectra,).
+        * "vlm_hit_rate": the fraction of the spectra in which each VLM is found, shape=(n_vlm,).
+        * "mean_shift_ppm" and "max_abs_shift_ppm": the mean shift and the maximum absolute shift of the VLMs found in
+          each spectrum, shape=(n_spectra,). NaN if no VLM is found.
+        * If region_edges is not None: "region_edges", and "region_shift_ppm_count", "region_mean_shift_ppm" and
+          "region_max_abs_shift_ppm", the statistics of the VLMs of each region, shape=(n_spectra, n_regions).
+    """
+    if corrector._vlm_mz is None:
+        raise RuntimeError("The VLM corrector must be fitted before computing diagnostics.")
+    vlm_mz = np.asarray(corrector._vlm_mz, dtype=np.float64)
+    n_spectra = len(spectra)
+    n_vlm = len(vlm_mz)
+
+    # The peaks that can be matched to a VLM, concatenated. The peaks of spectrum i are at offsets[i]:offsets[i + 1].
+    mz_values, intensity_values, offsets = _concatenate_peaks(spectra)
+    spectrum_ids = np.repeat(np.arange(n_spectra), np.diff(offsets))
+    is_intense = intensity_values > corrector.minimum_peak_intensity
+    mz_values = mz_values[is_intense]
+    spectrum_ids = spectrum_ids[is_intense]
+    offsets = np.searchsorted(spectrum_ids, np.arange(n_spectra + 1), side="left")
+
+    # Offsetting the m/z values of each spectrum by a multiple of a stride larger than any m/z value makes the
+    # concatenated peaks sorted, so that the VLMs of all the spectra are searched at once
+    stride = 2.0 * max(mz_values.max() if len(mz_values) > 0 else 0.0, vlm_mz.max() if n_vlm > 0 else 0.0) + 1.0
+    query_ids = np.repeat(np.arange(n_spectra), n_vlm)
+    query_mz = np.tile(vlm_mz, n_spectra)
+    insert_idx = np.searchsorted(mz_values + spectrum_ids * stride, query_mz + query_ids * stride, side="left")
+
+    # Closest peak to each VLM within its spectrum. Ties go to the smallest m/z (see take_closest_lo)
+    observed_mz = find_closest_values(mz_values, query_mz, first_idx=offsets[query_ids],
+                                      last_idx=offsets[query_ids + 1] - 1, insert_idx=insert_idx)
+    with np.errstate(invalid="ignore"):
+        is_found = np.abs(observed_mz - query_mz) <= query_mz * corrector.window_size_ppm
+    shift_ppm = np.where(is_found, (observed_mz - query_mz) / query_mz * 10**6, np.nan)
+
+    found_matrix = is_found.reshape(n_spectra, n_vlm)
+    n_found = np.count_nonzero(found_matrix, axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        hit_rate = n_found / n_vlm
+        vlm_hit_rate = np.count_nonzero(found_matrix, axis=0) / n_spectra
+    _, mean_shift_ppm, max_abs_shift_ppm = _group_statistics(shift_ppm, query_ids, n_spectra)
+    report = {"vlm_mz": vlm_mz,
+              "shift_ppm": shift_ppm.reshape(n_spectra, n_vlm),
+              "n_found": n_found,
+              "hit_rate": hit_rate,
+              "vlm_hit_rate": vlm_hit_rate,
+              "mean_shift_ppm": mean_shift_ppm,
+              "max_abs_shift_ppm": max_abs_shift_ppm}
+    if region_edges is not None:
+        _add_region_statistics(report, "shift_ppm", shift_ppm, query_ids, query_mz, region_edges, n_spectra)
+    return report
+
+def alignment_diagnostics(aligner, spectra, region_edges=None):
+    """
+    Measures how the peaks of spectra are moved by an aligner, before they are aligned.
+
+    Parameters
+    ----------
+    aligner: Mass_Spectra_Aligner
+        A fitted aligner.
+
+    spectra: list of Spectrum
+        The spectra, before the alignment.
+
+    region_edges: array-like, default=None
+        The sorted m/z boundaries of the regions in which the statistics are also computed. Region i contains the m/z
+        values in [region_edges[i], region_edges[i + 1]). If None, no region statistics are computed.
+
+    Returns
+    -------
+    report: dict
+        * "n_peaks": the number of peaks of each spectrum, shape=(n_spectra,).
+        * "n_unmatched": the number of peaks of each spectrum that have no alignment point in their window and are left
+          in place, shape=(n_spectra,).
+        * "unmatched_rate": the fraction of the peaks of each spectrum that are unmatched, shape=(n_spectra,). NaN for
+          spectra without peaks.
+        * "mean_shift_ppm" and "max_abs_shift_ppm": the mean shift and the maximum absolute shift of the matched peaks of
+          each spectrum, (alignment point - m/z) / m/z in ppm, shape=(n_spectra,). NaN if no peak is matched.
+        * If region_edges is not None: "region_edges", "region_unmatched_count", and "region_shift_ppm_count",
+          "region_mean_shift_ppm" and "region_max_abs_shift_ppm", the statistics of the matched peaks of each region,
+          shape=(n_spectra, n_regions).
+    """
+    if len(aligner.reference_mz) == 0:
+        raise RuntimeError("The aligner must be fitted before computing diagnostics.")
+    reference_mz = np.sort(np.asarray(aligner.reference_mz, dtype=np.float64))
+    n_spectra = len(spectra)
+
+    mz_values, _, offsets = _concatenate_peaks(spectra)
+    n_peaks = np.diff(offsets)
+    spectrum_ids = np.repeat(np.arange(n_spectra), n_peaks)
+
+    # The alignment points are the same for all the spectra, so all the peaks are matched at once. Ties go to the
+    # smallest m/z (see take_closest)
+    aligned_mz = find_closest_values_in_window(reference_mz, mz_values, aligner.window_size)
+    is_matched = ~np.isnan(aligned_mz)
+    shift_ppm = (aligned_mz - mz_values) / mz_values * 10**6
+
+    n_unmatched = np.bincount(spectrum_ids[~is_matched], minlength=n_spectra)
+    _, mean_shift_ppm, max_abs_shift_ppm = _group_statistics(shift_ppm, spectrum_ids, n_spectra)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        unmatched_rate = n_unmatched / n_peaks
+    report = {"n_peaks": n_peaks,
+              "n_unmatched": n_unmatched,
+              "unmatched_rate": unmatched_rate,
+              "mean_shift_ppm": mean_shift_ppm,
+              "max_abs_shift_ppm": max_abs_shift_ppm}
+    if region_edges is not None:
+        _add_region_statistics(report, "shift_ppm", shift_ppm, spectrum_ids, mz_values, region_edges, n_spectra)
+        n_regions = len(report["region_edges"]) - 1
+        regions = _region_indices(mz_values, report["region_edges"])
+        is_counted = ~is_matched & (regions >= 0)
+        report["region_unmatched_count"] = np.bincount(spectrum_ids[is_counted] * n_regions + regions[is_counted],
+                                                       minlength=n_spectra * n_regions).reshape(n_spectra, n_regions)
+    return report
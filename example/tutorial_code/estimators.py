@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+scikit-learn compatible versions of the pre-processors. They accept lists (or object arrays) of spectra and can be
+combined with a classifier in a scikit-learn Pipeline. Passing memory= to the Pipeline caches the fitted
+pre-processors, so that a GridSearchCV over the classifier parameters fits the pre-processing only once per fold.
+
+Example:
+--------
+pipeline = make_spectra_pipeline(DecisionTreeClassifier(), memory="cache_directory")
+learner = GridSearchCV(pipeline, param_grid={"classifier__max_depth": [1, 2, 3]}, cv=5)
+learner.fit(spectra, tags)
+"""
+
+from __future__ import print_function, division, absolute_import, unicode_literals
+import numpy as np
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.pipeline import Pipeline
+from sklearn.utils.validation import check_is_fitted
+from .alignment import Mass_Spectra_Aligner
+from .spectrum_utils import ThresholdedPeakFiltering
+from .utils import spectrum_to_matrix
+from .virtual_lock_mass import VirtualLockMassCorrector
+
+class PeakFilteringTransformer(BaseEstimator, TransformerMixin):
+    """
+    Removes the peaks that are less intense than a given threshold (see ThresholdedPeakFiltering).
+    """
+
+    def __init__(self, threshold=1.0, remove_mz_values=True):
+        self.threshold = threshold
+        self.remove_mz_values = remove_mz_values
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X):
+        return ThresholdedPeakFiltering(threshold=self.threshold,
+                                        remove_mz_values=self.remove_mz_values).transform(X)
+
+class VirtualLockMassTransformer(BaseEstimator, TransformerMixin):
+    """
+    Corrects the m/z values of the spectra using virtual lock masses (see VirtualLockMassCorrector).
+    """
+
+    def __init__(self, window_size=40, minimum_peak_intensity=1000, max_skipped_points=None, mode='flat',
+                 poly_degree=1):
+        self.window_size = window_size
+        self.minimum_peak_intensity = minimum_peak_intensity
+        self.max_skipped_points = max_skipped_points
+        self.mode = mode
+        self.poly_degree = poly_degree
+
+    def fit(self, X, y=None):
+        self.corrector_ = VirtualLockMassCorrector(window_size=self.window_size,
+                                                   minimum_peak_intensity=self.minimum_peak_intensity,
+                                                   max_skipped_points=self.max_skipped_points, mode=self.mode,
+                                                   poly_degree=self.poly_degree)
+        self.corrector_.fit(X)
+        return self
+
+    def transform(self, X):
+        check_is_fitted(self, "corrector_")
+        return self.corrector_.transform(X)
+
+class AlignmentTransformer(BaseEstimator, TransformerMixin):
+    """
+    Aligns the peaks of the spectra on alignment points (see Mass_Spectra_Aligner).
+    """
+
+    def __init__(self, window_size=10):
+        self.window_size = window_size
+
+    def fit(self, X, y=None):
+        self.aligner_ = Mass_Spectra_Aligner(window_size=self.window_size)
+        self.aligner_.fit(X)
+        return self
+
+    def transform(self, X):
+        check_is_fitted(self, "aligner_")
+        return self.aligner_.transform(X)
+
+class SpectrumVectorizer(BaseEstimator, TransformerMixin):
+    """
+    Converts spectra to a matrix of peak intensities. The columns are the m/z values of the training spectra. Peaks at
+    other m/z values are ignored.
+    """
+
+    def __init__(self, dtype=None):
+        self.dtype = dtype
+
+    def fit(self, X, y=None):
+        self.mz_values_ = np.unique(np.concatenate([s.mz_values for s in X]))
+        return self
+
+    def transform(self, X):
+        check_is_fitted(self, "mz_values_")
+        return spectrum_to_matrix(X, dtype=self.dtype, mz_values=self.mz_values_)
+
+def make_spectra_pipeline(classifier, threshold=250, vlm_window_size=40, vlm_minimum_peak_intensity=1000,
+                          alignment_window_size=30, memory=None):
+    """
+    Creates a Pipeline that pre-processes spectra and classifies them.
+
+    Parameters
+    ----------
+    classifier: scikit-learn classifier
+        The classifier applied to the matrix of peak intensities. Its parameters are prefixed by "classifier__".
+
+    threshold: float, default=250
+        The intensity threshold of the peak filtering step.
+
+    vlm_window_size: float, default=40
+        The window size (ppm) of the virtual lock mass correction. If None, the correction is skipped.
+
+    vlm_minimum_peak_intensity: float, default=1000
+        The minimum intensity of the peaks considered by the virtual lock mass correction.
+
+    alignment_window_size: float, default=30
+        The window size (ppm) of the alignment. If None, the alignment is skipped.
+
+    memory: str or joblib.Memory, default=None
+        Used to cache the fitted pre-processors (see sklearn.pipeline.Pipeline). If None, no caching is done.
+
+    Returns
+    -------
+    pipeline: Pipeline
+        The pipeline.
+    """
+    steps = [("thresholding", PeakFilteringTransformer(threshold=threshold))]
+    if vlm_window_size is not None:
+        steps.append(("vlm", VirtualLockMassTransformer(window_size=vlm_window_size,
+                                                        minimum_peak_intensity=vlm_minimum_peak_intensity)))
+    if alignment_window_size is not None:
+        steps.append(("alignment", AlignmentTransformer(window_size=alignment_window_size)))
+    steps.append(("vectorizer", SpectrumVectorizer()))
+    steps.append(("classifier", classifier))
+    return Pipeline(steps, memory=memory)
@@ -4,13 +4,129 @@ from __future__ import print_function, division, absolute_import, unicode_litera
 import numpy as np
 from copy import deepcopy
 
+class StorageMode(object):
+    """
+    Describes how the peaks of a spectrum are stored in memory.
+
+    Precision guarantees:
+    ---------------------
+    * m/z values are always rounded to the m/z precision of the spectrum. In fixed-point mode, they are stored as
+      unsigned 32-bit integer multiples of 10^-mz_precision and are decoded to exactly the same float64 values as in
+      the default mode. The largest m/z value that can be stored is (2^32 - 1) / 10^mz_precision, e.g.: 429496.7295
+      for mz_precision=4.
+    * float32 intensity values have a relative error of at most 2^-24 (about 6e-8). Integers up to 2^24 are exact.
+    * uint32 intensity values (counts) are exact, but only non-negative integers smaller than 2^32 are accepted.
+    """
+
+    def __init__(self, intensity_dtype=None, fixed_point_mz=False):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        intensity_dtype: numpy dtype, default=None
+                         The dtype used to store the intensity values (e.g.: np.float64, np.float32 or np.uint32). If
+                         None, the dtype of the input intensity values is kept.
+
+        fixed_point_mz: bool, default=False
+                        Specifies if the m/z values are stored as fixed-point (uint32) numbers rather than float64.
+        """
+        self.intensity_dtype = np.dtype(intensity_dtype) if intensity_dtype is not None else None
+        self.fixed_point_mz = fixed_point_mz
+
+    def encode_mz(self, mz_values, mz_precision):
+        """
+        Converts rounded float64 m/z values to their storage representation.
+        """
+        if not self.fixed_point_mz:
+            return mz_values
+        scaled_mz_values = np.round(mz_values * 10.0 ** mz_precision)
+        if len(scaled_mz_values) > 0 and (scaled_mz_values[0] < 0 or
+                                          scaled_mz_values[-1] > np.iinfo(np.uint32).max):
+            raise ValueError("The m/z values cannot be stored in fixed-point with a precision of %d decimals."
+                             % mz_precision)
+        return scaled_mz_values.astype(np.uint32)
+
+    def decode_mz(self, stored_mz_values, mz_precision):
+        """
+        Converts stored m/z values back to float64 m/z values.
+        """
+        if not self.fixed_point_mz:
+            return stored_mz_values
+        return stored_mz_values / 10.0 ** mz_precision
+
+    def encode_intensity(self, intensity_values):
+        """
+        Converts intensity values to their storage representation.
+        """
+        if self.intensity_dtype is None or intensity_values.dtype == self.intensity_dtype:
+            return intensity_values
+        if self.intensity_dtype.kind == "u":
+            if np.any(intensity_values < 0) or np.any(intensity_values != np.round(intensity_values)) or \
+                    np.any(intensity_values > np.iinfo(self.intensity_dtype).max):
+                raise ValueError("Intensity values must be non-negative integers to be stored as %s."
+                                 % self.intensity_dtype)
+        return intensity_values.astype(self.intensity_dtype)
+
+    def __eq__(self, other):
+        return isinstance(other, StorageMode) and self.intensity_dtype == other.intensity_dtype and \
+               self.fixed_point_mz == other.fixed_point_mz
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((str(self.intensity_dtype), self.fixed_point_mz))
+
+    def __repr__(self):
+        return "StorageMode(intensity_dtype=%s, fixed_point_mz=%s)" % (self.intensity_dtype, self.fixed_point_mz)
+
+DEFAULT_STORAGE = StorageMode()  # float64 m/z, intensity dtype of the input
+COMPACT_STORAGE = StorageMode(intensity_dtype=np.float32)  # float64 m/z, float32 intensities
+FIXED_POINT_STORAGE = StorageMode(intensity_dtype=np.float32, fixed_point_mz=True)  # uint32 m/z, float32 intensities
+COUNTS_STORAGE = StorageMode(intensity_dtype=np.uint32, fixed_point_mz=True)  # uint32 m/z, uint32 intensities
+
+def _sort_and_merge_peaks(mz_values, intensity_values, mz_precision):
+    """
+    Sorts peaks by m/z, rounds the m/z values to mz_precision decimals and sums the intensities of the peaks that have
+    the same rounded m/z value. Returns new arrays.
+    """
+    mz_values = np.asarray(mz_values)
+    intensity_values = np.asarray(intensity_values)
+
+    # Sort the peaks by mz. Raw spectra are usually already sorted, in which case only a copy is needed.
+    if np.all(mz_values[1:] > mz_values[:-1]):
+        intensity_values = intensity_values.copy()
+    else:
+        sort_mz = np.argsort(mz_values)
+        mz_values = mz_values[sort_mz]
+        intensity_values = intensity_values[sort_mz]
+
+    # Round the mz values based on the mz precision
+    mz_values = np.asarray(np.round(mz_values, mz_precision), dtype=np.float64)
+
+    # Contiguous mz values might now be equivalent. Combine their intensity values by taking the sum.
+    # Note: The mz values are still sorted after rounding, so the duplicates are contiguous
+    is_new_mz = np.empty(len(mz_values), dtype=bool)
+    is_new_mz[:1] = True
+    np.not_equal(mz_values[1:], mz_values[:-1], out=is_new_mz[1:])
+    if np.all(is_new_mz):
+        return mz_values, intensity_values
+    unique_mz = mz_values[is_new_mz]
+
+    # Note: The sums are accumulated in float64, whatever the dtype of the intensity values
+    unique_mz_intensities = np.bincount(np.cumsum(is_new_mz) - 1, weights=intensity_values, minlength=len(unique_mz))
+
+    return unique_mz, unique_mz_intensities
+
 class Spectrum(object):
-    def __init__(self, mz_values, intensity_values, mz_precision=4, metadata=None):
+    def __init__(self, mz_values, intensity_values, mz_precision=4, metadata=None, storage=None):
         self._peaks_mz = np.array([])
         self._peaks_intensity = np.array([])
-        self._peaks = {}
+        self._peaks = None
         self.metadata = metadata
         self._mz_precision = mz_precision  # in decimals e.g.: mz_precision=3 => 5.342
+        self._storage = storage if storage is not None else DEFAULT_STORAGE
 
         if len(mz_values) != len(intensity_values):
             raise ValueError("The number of mz values must be equal to the number of intensity values.")
@@ -21,6 +137,9 @@ class Spectrum(object):
         """
         Note: Peaks are not necessarily sorted here because of dict
         """
+        # The dict is only built when it is needed, since it is larger than the peak arrays
+        if self._peaks is None:
+            self._peaks = dict([(round(mz, self._mz_precision), intensity) for mz, intensity in self])
         return self._peaks
 
     @property
@@ -28,7 +147,11 @@ class Spectrum(object):
         """
         Note: Returned values are always sorted
         """
-        return self._peaks_mz
+        if not self._storage.fixed_point_mz:
+            return self._peaks_mz
+        mz_values = self._storage.decode_mz(self._peaks_mz, self._mz_precision)
+        mz_values.flags.writeable = False
+        return mz_values
 
     @property
     def mz_precision(self):
@@ -39,6 +162,10 @@ class Spectrum(object):
         self._mz_precision = new_precision
         self.set_peaks(self.mz_values, self.intensity_values)
 
+    @property
+    def storage(self):
+        return self._storage
+
     @property
     def intensity_values(self):
         return self._peaks_intensity
@@ -46,7 +173,7 @@ class Spectrum(object):
     def intensity_at(self, mz):
         mz = round(mz, self._mz_precision)
         try:
-            intensity = self._peaks[mz]
+            intensity = self.peaks()[mz]
         except:
             intensity = 0.0
         return intensity
@@ -55,42 +182,15 @@ class Spectrum(object):
         # XXX: This function must create a copy of mz_values and intensity_values to prevent the modification of
         # referenced arrays. This is assumed by other functions. Be careful!
 
-        # Sort the peaks by mz
-        sort_mz = np.argsort(np.asarray(mz_values))
-        mz_values = np.asarray(mz_values)[sort_mz]
-        intensity_values = np.asarray(intensity_values)[sort_mz]
-
-        # Round the mz values based on the mz precision
-        mz_values = np.asarray(np.round(mz_values, self._mz_precision), dtype=np.float)
-
-        # Contiguous mz values might now be equivalent. Combine their intensity values by taking the sum.
-        unique_mz = np.unique(mz_values)
-        unique_mz_intensities = np.zeros(unique_mz.shape)
-
-        # Note: This assumes that mz_values and unique_mz are sorted
-        if len(mz_values) != len(unique_mz):
-            acc = 0
-            current_unique_mz_idx = 0
-            current_unique_mz = unique_mz[0]
-            for i, mz in enumerate(mz_values):
-                if mz != current_unique_mz:
-                    unique_mz_intensities[current_unique_mz_idx] = acc  # Flush the accumulator
-                    acc = 0  # Reset the accumulator
-                    current_unique_mz_idx += 1  # Go to the next unique mz value
-                    current_unique_mz = unique_mz[current_unique_mz_idx]  # Get the unique mz value
-                acc += intensity_values[i]  # Increment the accumulator
-            unique_mz_intensities[current_unique_mz_idx] = acc  # Flush the accumulator
-        else:
-            unique_mz_intensities = intensity_values
-
-        self._peaks_mz = unique_mz
+        unique_mz, unique_mz_intensities = _sort_and_merge_peaks(mz_values, intensity_values, self._mz_precision)
+
+        self._peaks_mz = self._storage.encode_mz(unique_mz, self._mz_precision)
         self._peaks_mz.flags.writeable = False
 
+        self._peaks_intensity = self._storage.encode_intensity(unique_mz_intensities)
         self._peaks_intensity.flags.writeable = False
-        self._peaks_intensity = unique_mz_intensities
 
-        self._peaks = dict([(round(self._peaks_mz[i], self._mz_precision), self._peaks_intensity[i]) for i in
-                            range(len(self._peaks_mz))])
+        self._peaks = None
 
         self._check_peaks_integrity()
 
@@ -107,17 +207,29 @@ class Spectrum(object):
         peak_iterator: iterator
             An iterator that yields tuples of (mz, int) for each peaks in the spectrum.
         """
-        return zip(self._peaks_mz, self._peaks_intensity)
+        return zip(self.mz_values, self._peaks_intensity)
 
     def __len__(self):
         return self._peaks_mz.shape[0]
 
+    def __getstate__(self):
+        # The peak dict is rebuilt when needed. Leaving it out makes pickling and hashing (e.g.: joblib) much faster.
+        state = self.__dict__.copy()
+        state["_peaks"] = None
+        return state
+
+    def __setstate__(self, state):
+        # Spectra pickled before the storage modes were introduced use the default storage
+        state.setdefault("_storage", DEFAULT_STORAGE)
+        self.__dict__.update(state)
+
     def _check_peaks_integrity(self):
         if not len(self._peaks_mz) == len(self._peaks_intensity):
             raise ValueError("The number of mz values must be equal to the number of intensity values.")
-        if not all(self._peaks_mz[i] <= self._peaks_mz[i + 1] for i in range(len(self._peaks_mz) - 1)):
+        mz_differences = np.diff(self._peaks_mz.astype(np.float64))
+        if np.any(mz_differences < 0):
             raise ValueError("Mz values must be sorted.")
-        if len(np.unique(self._peaks_mz)) != len(self._peaks_mz):
+        if np.any(mz_differences == 0):
             raise ValueError("Mz value list contains duplicate values.")
 
 def copy_spectrum(spectrum):
@@ -136,7 +248,24 @@ def copy_spectrum(spectrum):
     metadata = deepcopy(spectrum.metadata)
     # XXX: The mz_values and intensity_values are copied in the constructor. No need to copy here.
     return Spectrum(mz_values=spectrum.mz_values, intensity_values=spectrum.intensity_values,
-                    mz_precision=int(spectrum.mz_precision), metadata=metadata)
+                    mz_precision=int(spectrum.mz_precision), metadata=metadata, storage=spectrum.storage)
+
+def _spectrum_from_sorted_peaks(mz_values, intensity_values, mz_precision=4, metadata=None, storage=None):
+    """
+    Creates a spectrum from peaks that are already sorted, unique and rounded to mz_precision (e.g.: read from a file
+    written by this package). Unlike the constructor, the arrays are not sorted, checked or copied, so that memory-mapped
+    arrays are used as is. They are only converted if the storage mode requires it.
+    """
+    spectrum = Spectrum.__new__(Spectrum)
+    spectrum._peaks = None
+    spectrum.metadata = metadata
+    spectrum._mz_precision = mz_precision
+    spectrum._storage = storage if storage is not None else DEFAULT_STORAGE
+    spectrum._peaks_mz = spectrum._storage.encode_mz(mz_values, mz_precision)
+    spectrum._peaks_mz.flags.writeable = False
+    spectrum._peaks_intensity = spectrum._storage.encode_intensity(intensity_values)
+    spectrum._peaks_intensity.flags.writeable = False
+    return spectrum
 
 def unify_mz(spectra):
     """
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+A persistent cache of pre-processed spectra. The pre-processed peaks are stored as .npy files (see npy_save) that are
+memory-mapped when they are loaded, so that reloading a dataset after a restart is almost instantaneous and that the
+processes that load the same dataset share its pages through the OS cache.
+
+Example:
+--------
+preprocessors = [ThresholdedPeakFiltering(threshold=250), VirtualLockMassCorrector(40, 1000)]
+spectra, preprocessors = load_preprocessed_spectra("dataset.h5", preprocessors, cache_dir=".spectra_cache")
+"""
+
+from __future__ import print_function, division, absolute_import, unicode_literals
+import hashlib
+import json
+import os
+import pickle
+import shutil
+from tempfile import mkdtemp, mkstemp
+from .spectrum_io import hdf5_load, npy_load, npy_save
+
+# Changing the cache layout or the pre-processing code must change this version, so that stale entries are ignored
+CACHE_VERSION = 1
+
+# The prefix of the directories in which the entries are written before they are added to the cache
+_TEMPORARY_PREFIX = ".tmp"
+
+# The file in which a cache directory keeps the checksums of the files (see file_checksum)
+_CHECKSUMS_FILE = "checksums.json"
+
+_file_checksums = {}
+
+def _load_checksums(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, _CHECKSUMS_FILE), "r") as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def _save_checksum(cache_dir, file_name, file_stat, checksum):
+    checksums = _load_checksums(cache_dir)
+    checksums[file_name] = {"size": file_stat.st_size, "mtime": file_stat.st_mtime, "checksum": checksum}
+    # The file is written to a temporary file that is then renamed, so that other processes never read a partially
+    # written file. If several processes add a checksum at once, some may be lost and will be computed again.
+    fd, temporary_file = mkstemp(dir=cache_dir, prefix=_TEMPORARY_PREFIX)
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(checksums, f)
+        os.replace(temporary_file, os.path.join(cache_dir, _CHECKSUMS_FILE))
+    finally:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+
+def file_checksum(file_name, cache_dir=None):
+    """
+    Computes the SHA-1 checksum of the content of a file. The checksum is only recomputed if the size or the
+    modification time of the file has changed since the last call.
+
+    Parameters
+    ----------
+    file_name: str
+        The path to the file.
+
+    cache_dir: str, default=None
+        The path to an existing cache directory in which the checksum is also stored, so that it is not recomputed after
+        a restart either. If None, the checksum is only kept in memory.
+
+    Returns
+    -------
+    checksum: str
+        The hexadecimal checksum.
+    """
+    file_name = os.path.abspath(file_name)
+    file_stat = os.stat(file_name)
+    stat_key = (file_name, file_stat.st_size, file_stat.st_mtime)
+    if stat_key in _file_checksums:
+        return _file_checksums[stat_key]
+
+    if cache_dir is not None:
+        stored = _load_checksums(cache_dir).get(file_name)
+        if stored is not None and (stored["size"], stored["mtime"]) == (file_stat.st_size, file_stat.st_mtime):
+            _file_checksums[stat_key] = stored["checksum"]
+            return stored["checksum"]
+
+    checksum = hashlib.sha1()
+    with open(file_name, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            checksum.update(block)
+    _file_checksums[stat_key] = checksum.hexdigest()
+    if cache_dir is not None:
+        _save_checksum(cache_dir, file_name, file_stat, _file_checksums[stat_key])
+    return _file_checksums[stat_key]
+
+def cache_key(file_name, preprocessors, storage=None, cache_dir=None):
+    """
+    Computes the key of the pre-processed spectra of a file in the cache.
+
+    Parameters
+    ----------
+    file_name: str
+        The path to the HDF5 file of the spectra.
+
+    preprocessors: list of pre-processors
+        The pre-processors, before they are fitted. Their parameters are part of the key.
+
+    storage: StorageMode, default=None
+        The storage mode of the spectra.
+
+    cache_dir: str, default=None
+        The path to the cache directory in which the checksum of the file is stored (see file_checksum).
+
+    Returns
+    -------
+    key: str
+        The key. It changes if the content of the file, the parameters of the pre-processors or the storage mode change.
+    """
+    key = hashlib.sha1()
+    key.update(("%d:%s:%r:" % (CACHE_VERSION, file_checksum(file_name, cache_dir), storage)).encode("utf-8"))
+    key.update(pickle.dumps(list(preprocessors), protocol=2))
+    return key.hexdigest()
+
+class SpectraCache(object):
+    """
+    A directory of pre-processed spectra. Each entry is a sub-directory named after its key (see cache_key) that
+    contains the spectra written by npy_save and the fitted pre-processors.
+    """
+
+    def __init__(self, cache_dir):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        cache_dir: str
+                   The path to the cache directory. It is created if needed.
+        """
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def __contains__(self, key):
+        return os.path.isdir(self._entry_dir(key))
+
+    def get(self, key, storage=None):
+        """
+        Loads an entry of the cache.
+
+        Parameters
+        ----------
+        key: str
+            The key of the entry.
+
+        storage: StorageMode, default=None
+            The storage mode of the loaded spectra. If None, the default storage mode is used.
+
+        Returns
+        -------
+        spectra: list of Spectrum or None
+            The memory-mapped spectra, or None if the entry does not exist.
+
+        preprocessors: list of pre-processors or None
+            The fitted pre-processors, or None if the entry does not exist.
+        """
+        if key not in self:
+            return None, None
+        entry_dir = self._entry_dir(key)
+        with open(os.path.join(entry_dir, "preprocessors.pkl"), "rb") as f:
+            preprocessors = pickle.load(f)
+        return npy_load(entry_dir, mmap=True, storage=storage), preprocessors
+
+    def put(self, key, spectra, preprocessors):
+        """
+        Adds an entry to the cache. Nothing is done if the entry already exists.
+
+        Parameters
+        ----------
+        key: str
+            The key of the entry.
+
+        spectra: list of Spectrum
+            The pre-processed spectra.
+
+        preprocessors: list of pre-processors
+            The fitted pre-processors.
+        """
+        if key in self:
+            return
+        # The entry is written to a temporary directory that is then renamed, so that other processes never see a
+        # partially written entry
+        temporary_dir = mkdtemp(dir=self.cache_dir, prefix=_TEMPORARY_PREFIX)
+        try:
+            npy_save(temporary_dir, spectra)
+            with open(os.path.join(temporary_dir, "preprocessors.pkl"), "wb") as f:
+                pickle.dump(list(preprocessors), f, protocol=2)
+            os.rename(temporary_dir, self._entry_dir(key))
+        except OSError:
+            # Another process added the entry in the meantime
+            if key not in self:
+                raise
+        finally:
+            if os.path.isdir(temporary_dir):
+                shutil.rmtree(temporary_dir)
+
+    def clear(self):
+        """
+        Removes all the entries of the cache. The entries that other processes are writing and the checksums of the
+        files, which remain valid, are left untouched.
+        """
+        for entry in os.listdir(self.cache_dir):
+            if not entry.startswith(_TEMPORARY_PREFIX) and entry != _CHECKSUMS_FILE:
+                shutil.rmtree(os.path.join(self.cache_dir, entry))
+
+def load_preprocessed_spectra(file_name, preprocessors, cache_dir, storage=None):
+    """
+    Loads the spectra of a HDF5 file, fits the pre-processors on them and transforms them. The result is cached: the
+    next calls with the same file and the same pre-processor parameters load the memory-mapped pre-processed spectra
+    instead.
+
+    Parameters
+    ----------
+    file_name: str
+        The path to the HDF5 file.
+
+    preprocessors: list of pre-processors
+        The unfitted pre-processors (e.g.: ThresholdedPeakFiltering, VirtualLockMassCorrector, Mass_Spectra_Aligner), in
+        the order in which they must be applied.
+
+    cache_dir: str
+        The path to the cache directory.
+
+    storage: StorageMode, default=None
+        The storage mode of the spectra. If None, the default storage mode is used.
+
+    Returns
+    -------
+    spectra: list of Spectrum
+        The pre-processed spectra. Their peaks are read-only views of the memory-mapped cache files.
+
+    preprocessors: list of pre-processors
+        The fitted pre-processors. When the spectra are loaded from the cache, these are copies of the pre-processors
+        that were fitted when the entry was created.
+    """
+    cache = SpectraCache(cache_dir)
+    key = cache_key(file_name, preprocessors, storage=storage, cache_dir=cache_dir)
+
+    spectra, fitted_preprocessors = cache.get(key, storage=storage)
+    if spectra is not None:
+        return spectra, fitted_preprocessors
+
+    spectra = hdf5_load(file_name, storage=storage)
+    for preprocessor in preprocessors:
+        preprocessor.fit(spectra)
+        spectra = preprocessor.transform(spectra)
+    cache.put(key, spectra, preprocessors)
+    return cache.get(key, storage=storage)
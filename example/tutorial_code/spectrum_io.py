@@ -3,9 +3,24 @@
 from __future__ import print_function, division, absolute_import, unicode_literals
 import h5py as h
 import json
-from .spectrum import Spectrum
+import numpy as np
+import os
+from threading import Thread, Event
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
+from .spectrum import Spectrum, _spectrum_from_sorted_peaks
 
-def hdf5_load(file_name, metadata=True):
+def _decode_metadata(spectrum_metadata):
+    if spectrum_metadata is None:
+        return None
+    try:
+        return json.loads(spectrum_metadata.decode("utf-8"))
+    except AttributeError:
+        return json.loads(spectrum_metadata)
+
+def hdf5_load(file_name, metadata=True, indices=None, storage=None):
     """
     Loads spectra from a HDF5 file.
 
@@ -17,6 +32,12 @@ def hdf5_load(file_name, metadata=True):
     metadata: boolean
         Defaults to True. Boolean to check if we load the metadata along with the spectrum data.
 
+    indices: array-like, dtype=int, default=None
+        The indices of the spectra to load. If None, all the spectra in the file are loaded.
+
+    storage: StorageMode, default=None
+        The storage mode of the loaded spectra (e.g.: COMPACT_STORAGE). If None, the default storage mode is used.
+
     Returns:
     -------
     spectra: list of Spectrum
@@ -33,14 +54,400 @@ def hdf5_load(file_name, metadata=True):
     else:
         spectra_metadata_dataset = [None] * spectra_intensity_dataset.shape[0]
 
+    if indices is not None:
+        # h5py only supports increasing indices for fancy indexing
+        indices = np.unique(np.asarray(indices, dtype=np.int64))
+        spectra_intensity_dataset = spectra_intensity_dataset[indices]
+        spectra_metadata_dataset = [spectra_metadata_dataset[i] for i in indices]
+
     spectra = []
     for spectrum_intensity_values, spectrum_metadata in zip(spectra_intensity_dataset, spectra_metadata_dataset):
-        try:
-            spectrum_metadata = json.loads(spectrum_metadata.decode("utf-8")) if not spectrum_metadata is None else None
-        except AttributeError:
-            spectrum_metadata = json.loads(spectrum_metadata) if not spectrum_metadata is None else None
         spectra.append(Spectrum(mz_values=mz_values, intensity_values=spectrum_intensity_values,
-                                mz_precision=mz_precision, metadata=spectrum_metadata))
+                                mz_precision=mz_precision, metadata=_decode_metadata(spectrum_metadata),
+                                storage=storage))
     file.close()
 
-    return spectra
\ No newline at end of file
+    return spectra
+
+class HDF5ChunkReader(object):
+    """
+    Iterates over the spectra of a HDF5 file by chunks. The next chunks are read and decoded on a background thread
+    while the current chunk is being processed, so that I/O and computation overlap.
+
+    Example:
+    --------
+    for spectra in HDF5ChunkReader("dataset.h5", chunk_size=16):
+        spectra = thresher.transform(spectra)
+    """
+
+    def __init__(self, file_name, chunk_size=64, prefetch=2, metadata=True, storage=None):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        file_name: str
+                   The path to the file to read.
+
+        chunk_size: int, default=64
+                    The number of spectra in each chunk.
+
+        prefetch: int, default=2
+                  The maximum number of chunks that are read in advance. This bounds the memory used by the reader.
+
+        metadata: bool, default=True
+                  Specifies if the metadata should be loaded along with the spectra.
+
+        storage: StorageMode, default=None
+                 The storage mode of the loaded spectra. If None, the default storage mode is used.
+        """
+        if chunk_size < 1 or prefetch < 1:
+            raise ValueError("The chunk size and the number of prefetched chunks must be at least 1.")
+        self.file_name = file_name
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+        self.metadata = metadata
+        self.storage = storage
+
+    def _read_chunks(self, chunk_queue, stop):
+        def put(item):
+            # Give up if the consumer stopped iterating, rather than blocking on a full queue forever
+            while not stop.is_set():
+                try:
+                    chunk_queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        try:
+            with h.File(self.file_name, "r") as file:
+                mz_precision = file["precision"][...]
+                mz_values = file["mz"][...]
+                spectra_intensity_dataset = file["intensity"]
+                load_metadata = self.metadata and "metadata" in file
+
+                for start in range(0, spectra_intensity_dataset.shape[0], self.chunk_size):
+                    stop_idx = min(start + self.chunk_size, spectra_intensity_dataset.shape[0])
+                    intensity_chunk = spectra_intensity_dataset[start:stop_idx]
+                    if load_metadata:
+                        metadata_chunk = [_decode_metadata(m) for m in file["metadata"][start:stop_idx]]
+                    else:
+                        metadata_chunk = [None] * (stop_idx - start)
+
+                    spectra = [Spectrum(mz_values=mz_values, intensity_values=spectrum_intensity_values,
+                                        mz_precision=mz_precision, metadata=spectrum_metadata, storage=self.storage)
+                               for spectrum_intensity_values, spectrum_metadata in zip(intensity_chunk, metadata_chunk)]
+                    if not put(spectra):
+                        return
+        except Exception as error:
+            put(error)
+            return
+        put(None)
+
+    def __iter__(self):
+        chunk_queue = Queue(maxsize=self.prefetch)
+        stop = Event()
+        reader = Thread(target=self._read_chunks, args=(chunk_queue, stop))
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                chunk = chunk_queue.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            stop.set()
+            reader.join()
+
+def hdf5_spectra_count(file_name):
+    """
+    Counts the spectra in a HDF5 file without loading them.
+
+    Parameters:
+    -----------
+    file_name: str
+        The path to the file.
+
+    Returns:
+    -------
+    n_spectra: int
+        The number of spectra in the file.
+    """
+    with h.File(file_name, "r") as file:
+        return file["intensity"].shape[0]
+
+def hdf5_save(file_name, spectra):
+    """
+    Saves spectra to a HDF5 file that can be read by hdf5_load.
+
+    Parameters:
+    -----------
+    file_name: str
+        The path to the file to create.
+
+    spectra: list of Spectrum
+        The spectra to save. They must all have the same m/z precision.
+
+    Note:
+    -----
+    * The spectra are stored on the union of their m/z values, like the files read by hdf5_load: each spectrum is
+      zero-padded with an intensity of 0.0 wherever it has no peak. hdf5_load returns these zero-intensity peaks; use
+      ThresholdedPeakFiltering to remove them.
+    * The intensities are stored with the common dtype of the spectra intensity values, compressed one spectrum per
+      chunk. Only one spectrum is held in memory at a time while writing.
+    """
+    mz_precision = int(spectra[0].mz_precision)
+    if any(int(spectrum.mz_precision) != mz_precision for spectrum in spectra):
+        raise ValueError("The m/z precision of the spectra must be equal in order to save them to the same file.")
+
+    mz_values = np.unique(np.concatenate([spectrum.mz_values for spectrum in spectra]))
+    intensity_dtype = np.result_type(*[spectrum.intensity_values.dtype for spectrum in spectra])
+
+    with h.File(file_name, "w") as file:
+        file.create_dataset("precision", data=mz_precision)
+        file.create_dataset("mz", data=mz_values, compression="gzip", compression_opts=4)
+        intensity_dataset = file.create_dataset("intensity", shape=(len(spectra), len(mz_values)),
+                                                dtype=intensity_dtype, chunks=(1, max(len(mz_values), 1)),
+                                                compression="gzip", compression_opts=4)
+        for i, spectrum in enumerate(spectra):
+            spectrum_intensity_values = np.zeros(len(mz_values), dtype=intensity_dtype)
+            spectrum_intensity_values[np.searchsorted(mz_values, spectrum.mz_values)] = spectrum.intensity_values
+            intensity_dataset[i] = spectrum_intensity_values
+        if any(spectrum.metadata is not None for spectrum in spectra):
+            file.create_dataset("metadata", data=[json.dumps(spectrum.metadata) for spectrum in spectra],
+                                dtype=h.special_dtype(vlen=str))
+
+def _concatenate_peaks(spectra):
+    """
+    Concatenates the peaks of spectra. Returns the m/z values, the intensity values and the offsets of the spectra (the
+    peaks of spectrum i are at offsets[i]:offsets[i + 1]).
+    """
+    offsets = np.zeros(len(spectra) + 1, dtype=np.int64)
+    np.cumsum([len(spectrum) for spectrum in spectra], out=offsets[1:])
+    if len(spectra) == 0:
+        return np.array([]), np.array([]), offsets
+    mz_values = np.concatenate([spectrum.mz_values for spectrum in spectra])
+    intensity_values = np.concatenate([spectrum.intensity_values for spectrum in spectra])
+    return mz_values, intensity_values, offsets
+
+def _spectra_from_peaks(mz_values, intensity_values, offsets, mz_precisions, metadata, storage=None):
+    return [_spectrum_from_sorted_peaks(mz_values[start:stop], intensity_values[start:stop],
+                                        mz_precision=mz_precision, metadata=spectrum_metadata, storage=storage)
+            for start, stop, mz_precision, spectrum_metadata in zip(offsets[:-1], offsets[1:], mz_precisions, metadata)]
+
+def _metadata_columns(spectra):
+    """
+    Splits the metadata of the spectra into columns: one column per key of dict metadata, or a single "metadata"
+    column otherwise. Values that are not scalars are JSON-encoded.
+    """
+    def encode(value):
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        return json.dumps(value)
+
+    metadata = [spectrum.metadata for spectrum in spectra]
+    if all(m is None for m in metadata):
+        return {}
+    if not all(isinstance(m, dict) or m is None for m in metadata):
+        return {"metadata": [encode(m) for m in metadata]}
+
+    keys = []
+    for m in metadata:
+        keys += [key for key in (m or {}) if key not in keys]
+    return dict((key, [encode(m.get(key)) if m is not None else None for m in metadata]) for key in keys)
+
+def _spectra_to_table(spectra):
+    import pyarrow as pa
+
+    mz_values, intensity_values, offsets = _concatenate_peaks(spectra)
+    spectrum_ids = np.repeat(np.arange(len(spectra), dtype=np.int32), np.diff(offsets))
+
+    names = ["spectrum_id", "mz", "intensity"]
+    columns = [pa.array(spectrum_ids), pa.array(mz_values), pa.array(intensity_values)]
+    # The metadata is stored once per spectrum and referenced by each of its peaks (dictionary encoding)
+    for key, values in _metadata_columns(spectra).items():
+        if key in names:
+            raise ValueError("The metadata key %s conflicts with a peak column." % key)
+        names.append(key)
+        try:
+            values = pa.array(values)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # The values do not share a type (e.g.: numbers and strings), so the non-strings are JSON-encoded
+            values = pa.array([value if value is None or isinstance(value, str) else json.dumps(value)
+                               for value in values])
+        if values.null_count == len(values):
+            # Null values cannot be dictionary-encoded
+            columns.append(pa.nulls(len(spectrum_ids)))
+            continue
+        values = values.dictionary_encode()
+        columns.append(pa.DictionaryArray.from_arrays(values.indices.take(pa.array(spectrum_ids)), values.dictionary))
+
+    # The exact spectra (including those without peaks) are kept in the schema metadata for columnar_load
+    spectra_info = {"mz_precision": [int(spectrum.mz_precision) for spectrum in spectra],
+                    "metadata": [spectrum.metadata for spectrum in spectra]}
+    return pa.Table.from_arrays(columns, names=names,
+                                metadata={"tutorial_code.spectra": json.dumps(spectra_info)})
+
+def spectra_to_dataframe(spectra):
+    """
+    Converts spectra to a long-format pandas DataFrame, with one row per peak.
+
+    Parameters:
+    -----------
+    spectra: list of Spectrum
+        The spectra to convert.
+
+    Returns:
+    -------
+    dataframe: pandas.DataFrame
+        The peaks of the spectra. The columns are "spectrum_id" (the index of the spectrum in the list), "mz",
+        "intensity" and one categorical column per metadata key (an empty column if the key is always None).
+
+    Note:
+    -----
+    * pandas and pyarrow must be installed.
+    """
+    return _spectra_to_table(spectra).to_pandas()
+
+def _columnar_format(file_name, format):
+    if format is None:
+        format = os.path.splitext(file_name)[1].lstrip(".").lower()
+    if format not in ("feather", "parquet"):
+        raise ValueError("Unknown columnar format: %s. Use feather or parquet." % format)
+    return format
+
+def columnar_save(file_name, spectra, format=None):
+    """
+    Saves spectra to a long-format Feather or Parquet file, with one row per peak. The file can be read by
+    columnar_load or by other tools (e.g.: pandas.read_parquet).
+
+    Parameters:
+    -----------
+    file_name: str
+        The path to the file to create.
+
+    spectra: list of Spectrum
+        The spectra to save.
+
+    format: str, default=None
+        "feather" or "parquet". If None, the format is inferred from the file extension.
+
+    Note:
+    -----
+    * The columns are "spectrum_id" (the index of the spectrum in the list), "mz", "intensity" and one column per
+      metadata key (see spectra_to_dataframe).
+    * pyarrow must be installed.
+    """
+    format = _columnar_format(file_name, format)
+    table = _spectra_to_table(spectra)
+    if format == "feather":
+        import pyarrow.feather as feather
+        feather.write_feather(table, file_name)
+    else:
+        import pyarrow.parquet as parquet
+        parquet.write_table(table, file_name)
+
+def columnar_load(file_name, format=None, storage=None):
+    """
+    Loads spectra from a file written by columnar_save.
+
+    Parameters:
+    -----------
+    file_name: str
+        The path to the file to load.
+
+    format: str, default=None
+        "feather" or "parquet". If None, the format is inferred from the file extension.
+
+    storage: StorageMode, default=None
+        The storage mode of the loaded spectra. If None, the default storage mode is used.
+
+    Returns:
+    -------
+    spectra: list of Spectrum
+        The spectra, in the order in which they were saved.
+    """
+    format = _columnar_format(file_name, format)
+    columns = ["spectrum_id", "mz", "intensity"]
+    if format == "feather":
+        import pyarrow.feather as feather
+        table = feather.read_table(file_name, columns=columns)
+    else:
+        import pyarrow.parquet as parquet
+        table = parquet.read_table(file_name, columns=columns)
+
+    schema_metadata = table.schema.metadata
+    if schema_metadata is None or b"tutorial_code.spectra" not in schema_metadata:
+        raise ValueError("The file %s was not written by columnar_save." % file_name)
+    spectra_info = json.loads(schema_metadata[b"tutorial_code.spectra"].decode("utf-8"))
+
+    # The peaks are stored by spectrum and sorted by m/z, so each spectrum is a slice of the columns
+    spectrum_ids = table.column("spectrum_id").to_numpy()
+    offsets = np.searchsorted(spectrum_ids, np.arange(len(spectra_info["mz_precision"]) + 1), side="left")
+    return _spectra_from_peaks(table.column("mz").to_numpy(), table.column("intensity").to_numpy(), offsets,
+                               spectra_info["mz_precision"], spectra_info["metadata"], storage=storage)
+
+def npy_save(directory, spectra):
+    """
+    Saves spectra to a directory of .npy files that can be memory-mapped by npy_load.
+
+    Parameters:
+    -----------
+    directory: str
+        The path to the directory. It is created if needed.
+
+    spectra: list of Spectrum
+        The spectra to save.
+
+    Note:
+    -----
+    * The directory contains the concatenated peaks of the spectra (mz.npy and intensity.npy), the offsets of the
+      spectra in these arrays (offsets.npy, the peaks of spectrum i are at offsets[i]:offsets[i + 1]) and the m/z
+      precision and metadata of the spectra (spectra.json). The .npy files can be read directly with numpy.load.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    mz_values, intensity_values, offsets = _concatenate_peaks(spectra)
+    np.save(os.path.join(directory, "mz.npy"), mz_values)
+    np.save(os.path.join(directory, "intensity.npy"), intensity_values)
+    np.save(os.path.join(directory, "offsets.npy"), offsets)
+    with open(os.path.join(directory, "spectra.json"), "w") as f:
+        json.dump({"mz_precision": [int(spectrum.mz_precision) for spectrum in spectra],
+                   "metadata": [spectrum.metadata for spectrum in spectra]}, f)
+
+def npy_load(directory, mmap=True, storage=None):
+    """
+    Loads spectra from a directory written by npy_save.
+
+    Parameters:
+    -----------
+    directory: str
+        The path to the directory.
+
+    mmap: bool, default=True
+        If True, the peaks are memory-mapped: they are read from the disk when they are accessed and the pages are shared
+        by all the processes that load the same directory. Otherwise, they are loaded in memory.
+
+    storage: StorageMode, default=None
+        The storage mode of the loaded spectra. If None, the default storage mode is used. Note that the peaks are
+        copied if they must be converted to the storage mode.
+
+    Returns:
+    -------
+    spectra: list of Spectrum
+        The spectra, in the order in which they were saved. Their m/z and intensity values are read-only views of the
+        memory-mapped arrays.
+    """
+    mmap_mode = "r" if mmap else None
+    mz_values = np.load(os.path.join(directory, "mz.npy"), mmap_mode=mmap_mode)
+    intensity_values = np.load(os.path.join(directory, "intensity.npy"), mmap_mode=mmap_mode)
+    offsets = np.load(os.path.join(directory, "offsets.npy"))
+    with open(os.path.join(directory, "spectra.json"), "r") as f:
+        spectra_info = json.load(f)
+    return _spectra_from_peaks(mz_values, intensity_values, offsets, spectra_info["mz_precision"],
+                               spectra_info["metadata"], storage=storage)
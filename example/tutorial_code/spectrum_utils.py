@@ -2,7 +2,9 @@
 
 from __future__ import print_function, division, absolute_import, unicode_literals
 import numpy as np
+import weakref
 from bisect import bisect_left
+from collections import OrderedDict
 from copy import deepcopy
 from .spectrum import Spectrum
 
@@ -25,7 +27,7 @@ def copy_spectrum_with_new_intensities(spectrum, new_intensity_values):
     metadata = deepcopy(spectrum.metadata)
     # XXX: The mz_values and intensity_values are copied in the constructor. No need to copy here.
     return Spectrum(mz_values=spectrum.mz_values, intensity_values=new_intensity_values,
-                    mz_precision=int(spectrum.mz_precision), metadata=metadata)
+                    mz_precision=int(spectrum.mz_precision), metadata=metadata, storage=spectrum.storage)
 
 def copy_spectrum_with_new_mz_and_intensities(spectrum, new_mz_values, new_intensity_values):
     """
@@ -48,7 +50,7 @@ def copy_spectrum_with_new_mz_and_intensities(spectrum, new_mz_values, new_inten
     metadata = deepcopy(spectrum.metadata)
     # XXX: The mz_values and intensity_values are copied in the constructor. No need to copy here.
     return Spectrum(mz_values=new_mz_values, intensity_values=new_intensity_values,
-                    mz_precision=int(spectrum.mz_precision), metadata=metadata)
+                    mz_precision=int(spectrum.mz_precision), metadata=metadata, storage=spectrum.storage)
 
 def binary_search_for_left_range(mz_values, left_range):
     """
@@ -144,6 +146,111 @@ def take_closest(my_list, my_number):
     else:
         return before
 
+def find_closest_values(sorted_values, values, first_idx=None, last_idx=None, insert_idx=None):
+    """
+    Vectorized version of take_closest: finds the closest sorted value to each value. If two sorted values are equally
+    close, the smallest one is chosen.
+
+    Parameters
+    ----------
+    sorted_values: array-like, dtype=float
+        The sorted values in which the closest values are searched.
+    values: array-like, dtype=float
+        The values for which the closest sorted values are searched.
+    first_idx, last_idx: array-like, dtype=int, default=None
+        For each value, the index of the first and of the last sorted value that can be chosen. If None, all the sorted
+        values can be chosen.
+    insert_idx: array-like, dtype=int, default=None
+        For each value, the index where it would be inserted in the sorted values (see np.searchsorted). It is computed
+        if it is not provided.
+
+    Returns
+    -------
+    closest_values: array-like, dtype=float
+        The closest sorted value to each value, or NaN if no sorted value can be chosen (i.e. first_idx > last_idx).
+    """
+    sorted_values = np.asarray(sorted_values, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    if first_idx is None:
+        first_idx = np.zeros(len(values), dtype=np.intp)
+    if last_idx is None:
+        last_idx = np.full(len(values), len(sorted_values) - 1, dtype=np.intp)
+    if insert_idx is None:
+        insert_idx = np.searchsorted(sorted_values, values, side="left")
+
+    has_candidate = first_idx <= last_idx
+    after_idx = np.clip(insert_idx, first_idx, last_idx)[has_candidate]
+    before_idx = np.maximum(after_idx - 1, first_idx[has_candidate])
+    candidate_values = values[has_candidate]
+    before = sorted_values[before_idx]
+    after = sorted_values[after_idx]
+
+    closest_values = np.full(len(values), np.nan)
+    closest_values[has_candidate] = np.where(after - candidate_values < candidate_values - before, after, before)
+    return closest_values
+
+def find_closest_values_in_window(sorted_values, values, window_size):
+    """
+    Finds the closest sorted value to each value among those in its window (see find_closest_values).
+
+    Parameters
+    ----------
+    sorted_values: array-like, dtype=float
+        The sorted values in which the closest values are searched.
+    values: array-like, dtype=float
+        The values for which the closest sorted values are searched.
+    window_size: float
+        The half-width of the window of each value, in ppm of the value.
+
+    Returns
+    -------
+    closest_values: array-like, dtype=float
+        The closest sorted value to each value, or NaN if there is no sorted value in its window.
+    """
+    sorted_values = np.asarray(sorted_values, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    window = values * window_size / 1000000.0
+    first_idx = np.searchsorted(sorted_values, values - window, side="left")
+    last_idx = np.searchsorted(sorted_values, values + window, side="right") - 1
+    return find_closest_values(sorted_values, values, first_idx, last_idx)
+
+def find_mz_partition_boundaries(sorted_mz_values, n_partitions, window_size_ppm):
+    """
+    Splits sorted m/z values into contiguous partitions that can be processed independently by window-based
+    algorithms. Each boundary is placed at the gap closest to an even split where no window of relative half-width
+    window_size_ppm can contain both the peaks before and the peaks after the gap.
+
+    Parameters
+    ----------
+    sorted_mz_values: array-like, dtype=float
+        The sorted m/z values of the peaks of all the spectra.
+    n_partitions: int
+        The desired number of partitions. Fewer partitions are returned if there are not enough gaps.
+    window_size_ppm: float
+        The relative half-width of the windows (e.g.: 40 ppm => 40e-6).
+
+    Returns
+    -------
+    boundaries: list of int
+        The index of the first peak of each partition, except the first one.
+    """
+    sorted_mz_values = np.asarray(sorted_mz_values)
+    if n_partitions <= 1 or len(sorted_mz_values) < 2:
+        return []
+
+    # A window containing a peak p starts at p / (1 + w) * (1 - w) or later
+    gaps = np.where(sorted_mz_values[1:] / (1 + window_size_ppm) * (1 - window_size_ppm) > sorted_mz_values[:-1])[0] + 1
+    if len(gaps) == 0:
+        return []
+
+    # Choose the gap closest to each even split
+    targets = len(sorted_mz_values) * np.arange(1, n_partitions) / n_partitions
+    next_gap_idx = np.searchsorted(gaps, targets)
+    previous_gaps = gaps[np.maximum(next_gap_idx - 1, 0)]
+    next_gaps = gaps[np.minimum(next_gap_idx, len(gaps) - 1)]
+    boundaries = np.where(targets - previous_gaps <= next_gaps - targets, previous_gaps, next_gaps)
+    return np.unique(boundaries).tolist()
+
 class PreprocessorMixin:
     """
     A mixin class for the spectrum pre-processing algorithms.
@@ -244,3 +351,89 @@ class ThresholdedPeakFiltering(PreprocessorMixin):
                                                                             spectra_list[i].mz_values[keep_mask],
                                                                             spectra_list[i].intensity_values[keep_mask])
         return spectra_list
+
+class ThresholdedPeakCache(object):
+    """
+    A bounded cache of the peaks of spectra that are more intense than a threshold. This avoids filtering the same
+    spectrum several times and building a new Spectrum for the result. The least recently used entries are evicted
+    first.
+
+    Note:
+    -----
+    * The entries are keyed by spectrum identity. An entry is invalidated if its spectrum is garbage collected or if
+      its peaks are replaced (e.g.: by set_peaks).
+    * If all the peaks of a spectrum are more intense than the threshold, the peak arrays of the spectrum are returned
+      without filtering or copying.
+    """
+
+    def __init__(self, max_size=1024):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        max_size: int, default=1024
+                  The maximum number of cached entries.
+        """
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+    def get(self, spectrum, threshold):
+        """
+        Returns the peaks of a spectrum that are more intense than a threshold.
+
+        Parameters
+        ----------
+        spectrum: Spectrum
+            The spectrum.
+
+        threshold: float
+            The intensity threshold. The peaks that have an intensity value less or equal to this threshold are
+            discarded.
+
+        Returns
+        -------
+        mz_values: array-like, dtype=float, shape=n_peaks
+            The m/z values of the remaining peaks (read-only).
+
+        intensity_values: array-like, shape=n_peaks
+            The intensity values of the remaining peaks (read-only).
+        """
+        key = (id(spectrum), threshold)
+        entry = self._entries.get(key)
+        if entry is not None:
+            spectrum_ref, source_intensity_values, mz_values, intensity_values = entry
+            if spectrum_ref() is spectrum and spectrum.intensity_values is source_intensity_values:
+                self._entries.move_to_end(key)
+                return mz_values, intensity_values
+
+        source_intensity_values = spectrum.intensity_values
+        mz_values = spectrum.mz_values
+        keep_mask = source_intensity_values > threshold
+        if keep_mask.all():
+            intensity_values = source_intensity_values
+        else:
+            mz_values = mz_values[keep_mask]
+            intensity_values = source_intensity_values[keep_mask]
+            mz_values.flags.writeable = False
+            intensity_values.flags.writeable = False
+
+        entries = self._entries
+        def remove_entry(spectrum_ref):
+            # Called when the spectrum is garbage collected. Its id may have been reused by a new entry since.
+            entry = entries.get(key)
+            if entry is not None and entry[0] is spectrum_ref:
+                del entries[key]
+        self._entries[key] = (weakref.ref(spectrum, remove_entry), source_intensity_values, mz_values,
+                              intensity_values)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+        return mz_values, intensity_values
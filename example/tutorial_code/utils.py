@@ -1,37 +1,56 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-from .spectrum import Spectrum, unify_mz
+from .spectrum import Spectrum, _is_mz_precision_equal
 from .spectrum_io import hdf5_load
+from .spectrum_cache import load_preprocessed_spectra
 from .spectrum_utils import ThresholdedPeakFiltering
-from copy import deepcopy
-from sklearn.metrics import zero_one_loss, f1_score, precision_score, recall_score
 
-def load_spectra(datafile):
+def load_spectra(datafile, storage=None, cache_dir=None):
     """
     Loads the spectra from an hdf5 file into memory
     :param datafile: the hdf5 file containing the spectra
+    :param storage: the StorageMode of the spectra (e.g.: COMPACT_STORAGE). None for the default storage.
+    :param cache_dir: a directory where the thresholded spectra are cached (see load_preprocessed_spectra). The next
+                      calls with the same file load them from the cache. None to disable caching.
     :return: the spectra in an ndarray.
     """
-    spectra = hdf5_load(datafile)
     thresher = ThresholdedPeakFiltering(threshold=250)
+    if cache_dir is not None:
+        spectra, _ = load_preprocessed_spectra(datafile, [thresher], cache_dir, storage=storage)
+        # Same type as the result of the thresher
+        return np.array(spectra)
+    spectra = hdf5_load(datafile, storage=storage)
     spectra = thresher.fit_transform(spectra)
     return spectra
 
-def spectrum_to_matrix(spectra):
+def spectrum_to_matrix(spectra, dtype=None, mz_values=None):
     """
     Convert an array of spectra to a ndarray
     :param spectra: The spectra to extract
+    :param dtype: The dtype of the matrix. None to use the common dtype of the spectra intensity values.
+    :param mz_values: The sorted m/z values of the columns. None to use the union of the m/z values of the spectra.
+                      Peaks at other m/z values are ignored.
     :return: ndarray of the peak intensities
     """
-    new_spectra = deepcopy(spectra)
-    unify_mz(new_spectra)
+    if not _is_mz_precision_equal(spectra[0].mz_precision, spectra):
+        raise ValueError("The m/z precision of the spectra must be equal in order to unify the m/z values.")
 
-    data = []
-    for s in new_spectra:
-        data.append(s.intensity_values)
+    if dtype is None:
+        dtype = np.result_type(*[s.intensity_values.dtype for s in spectra])
 
-    return np.asarray(data)
+    # Equivalent to unify_mz on a copy of the spectra, without building the intermediate spectra
+    if mz_values is None:
+        mz_values = np.unique(np.concatenate([s.mz_values for s in spectra]))
+    data = np.zeros((len(spectra), len(mz_values)), dtype=dtype)
+    if len(mz_values) == 0:
+        return data
+    for i, s in enumerate(spectra):
+        columns = np.minimum(np.searchsorted(mz_values, s.mz_values), len(mz_values) - 1)
+        on_grid = mz_values[columns] == s.mz_values
+        data[i, columns[on_grid]] = s.intensity_values[on_grid]
+
+    return data
 
 def extract_tags(spectra):
     tags = []
@@ -45,6 +64,9 @@ def extract_tags(spectra):
     return np.asarray(tags)
 
 def evaluate_learner(y_true, y_pred):
+    # Imported here since scikit-learn is slow to import and is not needed for pre-processing
+    from sklearn.metrics import zero_one_loss, f1_score, precision_score, recall_score
+
     results = {}
     results["zero_one_loss"] = zero_one_loss(y_true, y_pred)
     results["f1_score"] = f1_score(y_true, y_pred)
@@ -2,10 +2,16 @@
 
 from __future__ import print_function, division, absolute_import, unicode_literals
 import numpy as np
+from multiprocessing import Pool, cpu_count
 from .spectrum_utils import copy_spectrum_with_new_mz_and_intensities
 from .spectrum_utils import binary_search_for_left_range
 from .spectrum_utils import binary_search_for_right_range, take_closest_lo
-from .spectrum_utils import ThresholdedPeakFiltering
+from .spectrum_utils import ThresholdedPeakCache, PreprocessorMixin, find_mz_partition_boundaries
+
+def _find_partition_vlm_peak_groups(partition):
+    window_size, peaks, spectrum_by_peak, n_spectra = partition
+    corrector = VirtualLockMassCorrector(window_size=window_size, minimum_peak_intensity=0)
+    return corrector._find_vlm_peak_groups_in_sorted_peaks(peaks, spectrum_by_peak, n_spectra)
 
 def is_window_vlm(spectrum_by_peak, window_start_idx, window_end_idx, n_spectra):
     # Check that the window contains the right number of peaks
@@ -19,10 +25,10 @@ def is_window_vlm(spectrum_by_peak, window_start_idx, window_end_idx, n_spectra)
     else:
         return False
 
-class VirtualLockMassCorrector(object):
+class VirtualLockMassCorrector(PreprocessorMixin):
 
     def __init__(self, window_size, minimum_peak_intensity, max_skipped_points=None,
-                 mode='flat', poly_degree=1):
+                 mode='flat', poly_degree=1, threshold_cache_size=1024):
         """
         Initiate a VirtualLockMassCorrector object.
         :param window_size: The distance from left to right in ppm
@@ -30,6 +36,8 @@ class VirtualLockMassCorrector(object):
         :param max_skipped_points: Maximum number of points that can be skipped during the transform step. None=any.
         :param mode: How the transformation is applied before the first VLM and after the last VLM. [flat only]
         :param poly_degree: Degree of the function used to calculate correction ratio between two VLM.
+        :param threshold_cache_size: Maximum number of spectra for which the peaks above minimum_peak_intensity are
+                                     kept in memory, so that they are only filtered once across fit and transform.
         :return:
         """
         self.window_size = window_size
@@ -39,6 +47,25 @@ class VirtualLockMassCorrector(object):
         self.max_skipped_points = max_skipped_points
         self.mode = mode
         self.polynomial_degree = poly_degree
+        self.threshold_cache_size = threshold_cache_size
+        self._threshold_cache = ThresholdedPeakCache(max_size=threshold_cache_size)
+
+    def __getstate__(self):
+        # The cache refers to the spectra by identity, which is meaningless in another process
+        state = self.__dict__.copy()
+        state["_threshold_cache"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._threshold_cache = ThresholdedPeakCache(max_size=getattr(self, "threshold_cache_size", 1024))
+
+    def _thresholded_peaks(self, spectrum):
+        """
+        Returns the m/z and intensity values of the peaks of a spectrum that are more intense than
+        minimum_peak_intensity.
+        """
+        return self._threshold_cache.get(spectrum, self.minimum_peak_intensity)
 
     def _compute_vlm_positions(self, peak_groups):
         """
@@ -56,54 +83,95 @@ class VirtualLockMassCorrector(object):
                 vlm_mz_values.append(center_of_mass)
         return np.array(vlm_mz_values)
 
-    def _find_vlm_peak_groups(self, spectra):
+    def _find_vlm_peak_groups(self, spectra_mz_values, n_jobs=1):
         # List all peaks of all spectra
-        peaks = np.concatenate(list(s.mz_values for s in spectra))
-        spectrum_by_peak = np.concatenate(list(np.ones(len(s), dtype=np.uint) * i for i, s in enumerate(spectra)))
+        peaks = np.concatenate(spectra_mz_values)
+        spectrum_by_peak = np.concatenate(list(np.ones(len(mz), dtype=np.uint) * i
+                                               for i, mz in enumerate(spectra_mz_values)))
 
         # Sort the peaks in increasing order of m/z
         sorter = np.argsort(peaks)
         peaks = peaks[sorter]
         spectrum_by_peak = spectrum_by_peak[sorter]
 
+        if n_jobs is None:
+            n_jobs = cpu_count()
+        if n_jobs == 1:
+            return self._find_vlm_peak_groups_in_sorted_peaks(peaks, spectrum_by_peak, len(spectra_mz_values))
+
+        # The m/z axis is split at gaps that no window can span, so the partitions give exactly the same groups as a
+        # single sweep
+        boundaries = find_mz_partition_boundaries(peaks, n_jobs, self.window_size_ppm)
+        if len(boundaries) == 0:
+            return self._find_vlm_peak_groups_in_sorted_peaks(peaks, spectrum_by_peak, len(spectra_mz_values))
+        boundaries = [0] + boundaries + [len(peaks)]
+        partitions = [(self.window_size, peaks[start:stop], spectrum_by_peak[start:stop], len(spectra_mz_values))
+                      for start, stop in zip(boundaries[:-1], boundaries[1:])]
+        pool = Pool(processes=min(n_jobs, len(partitions)))
+        try:
+            partition_groups = pool.map(_find_partition_vlm_peak_groups, partitions, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return [group for groups in partition_groups for group in groups]
+
+    def _find_vlm_peak_groups_in_sorted_peaks(self, peaks, spectrum_by_peak, n_spectra, last_equal_peak_idx=None):
+        """
+        Finds the groups of peaks that match the definition of a VLM.
+
+        Note: assumes that the peaks of all the spectra are concatenated and sorted in increasing order of m/z, with
+        spectrum_by_peak containing the index of the spectrum of each peak. last_equal_peak_idx contains, for each
+        peak, the index of the last peak with the same m/z. It does not depend on the window size and is computed if
+        it is not provided.
+        """
         vlm_peak_groups = []
 
+        if len(peaks) == 0:
+            return vlm_peak_groups
+
+        if last_equal_peak_idx is None:
+            last_equal_peak_idx = np.searchsorted(peaks, peaks, side="right") - 1
+
+        # Scalar accesses are much faster on lists than on numpy arrays
+        peak_list = peaks.tolist()
+        last_equal_peak_list = last_equal_peak_idx.tolist()
+
         # Start by considering the first window that contains the first peak
         window_start_idx = 0
-        window_end_idx = np.searchsorted(peaks, peaks[0], side="right") - 1
+        window_end_idx = last_equal_peak_list[0]
 
-        while window_start_idx < len(peaks):
+        while window_start_idx < len(peak_list):
 
             # Check if the current group of peaks matches the definition of a VLM
-            if is_window_vlm(spectrum_by_peak, window_start_idx, window_end_idx, len(spectra)):
+            if is_window_vlm(spectrum_by_peak, window_start_idx, window_end_idx, n_spectra):
                 vlm_peak_groups.append(peaks[window_start_idx : window_end_idx + 1])
 
             # Find the m/z of the first peak in the current group
-            window_first_peak_mz = peaks[window_start_idx]
+            window_first_peak_mz = peak_list[window_start_idx]
 
             # Check if there are peaks beyond the last peak of the group
-            if window_end_idx < len(peaks) - 1:
+            if window_end_idx < len(peak_list) - 1:
 
                 # The outer right peak is the peak following the last peak of the group in the list
                 # We find the lower bound (in m/z) of the first window that contains this peak
-                outer_right_peak_window_start_mz = (peaks[window_end_idx + 1] / (1 + self.window_size_ppm)) * (1 - self.window_size_ppm)
+                outer_right_peak_window_start_mz = (peak_list[window_end_idx + 1] / (1 + self.window_size_ppm)) * (1 - self.window_size_ppm)
 
                 # Case 1: There exists a window containing the first peak of the group and the outer right peak
                 if outer_right_peak_window_start_mz <= window_first_peak_mz:
                     # We include the outer right peak in the group
-                    window_end_idx = np.searchsorted(peaks, peaks[window_end_idx + 1], side='right') - 1
+                    window_end_idx = last_equal_peak_list[window_end_idx + 1]
 
                 # Case 2: There does not exist a window containing the first peak and the outer right peak simultaneously
                 else:
                     # Since the condition is false, there necessarily exists a non-zero space between the first peak of
                     # the window and the lower bound of the first window where the outer right peak is included. We thus
                     # consider the window containing all the peaks in the group, except the first peak.
-                    window_next_peak_idx = np.searchsorted(peaks, window_first_peak_mz, side='right')
+                    window_next_peak_idx = last_equal_peak_list[window_start_idx] + 1
                     window_start_idx = window_next_peak_idx
 
             else:
                 # There are no peaks with a greater m/z than the last peak of the group. We simply remove the first peak.
-                window_next_peak_idx = np.searchsorted(peaks, window_first_peak_mz, side='right')
+                window_next_peak_idx = last_equal_peak_list[window_start_idx] + 1
                 window_start_idx = window_next_peak_idx
 
         return vlm_peak_groups
@@ -119,18 +187,21 @@ class VirtualLockMassCorrector(object):
 
         inconsistencies = np.where(vlm_window_starts[1:] <= vlm_window_ends[: -1])[0]
 
-        rejection_mask = np.zeros(len(vlm_mz_values), dtype=np.bool)
+        rejection_mask = np.zeros(len(vlm_mz_values), dtype=bool)
         rejection_mask[inconsistencies] = True
         rejection_mask[inconsistencies + 1] = True
 
         return vlm_mz_values[~rejection_mask]
 
     def _preprocess_spectra(self, spectra):
-        return ThresholdedPeakFiltering(threshold=self.minimum_peak_intensity, remove_mz_values=True).fit_transform(spectra)
+        return [self._thresholded_peaks(spectrum)[0] for spectrum in spectra]
+
+    def _find_vlm_peaks(self, spectra, n_jobs=1):
+        spectra_mz_values = self._preprocess_spectra(spectra)
+        peak_groups = self._find_vlm_peak_groups(spectra_mz_values, n_jobs=n_jobs)
+        return self._vlm_peaks_from_groups(peak_groups)
 
-    def _find_vlm_peaks(self, spectra):
-        spectra = self._preprocess_spectra(spectra)
-        peak_groups = self._find_vlm_peak_groups(spectra)
+    def _vlm_peaks_from_groups(self, peak_groups):
         vlm_mz_values = self._compute_vlm_positions(peak_groups)
         pre_vlm_count = len(vlm_mz_values)
         vlm_mz_values = self._make_vlm_set_consistent(vlm_mz_values)
@@ -147,27 +218,29 @@ class VirtualLockMassCorrector(object):
             raise ValueError("There must be at least 3 points to use virtual lock-mass")
 
         # Correction is done on a copy of the spectrum. The original spectrum will not be modified.
+        # The m/z values are read once, since they are decoded at each access in fixed-point storage.
+        mz_values = spectrum.mz_values
 
         found_vlm, observed_mz = self._find_vlock_mass_in_spectra(spectrum) # Find the corresponding points
         correction_ratios = self._calculate_correction_ratios(found_vlm, observed_mz) # Calculate correction ratios at each VLM
 
         # Correct the points smaller than observed_mz[0]
-        corrected_mz = self._correct_points_smaller_than(spectrum, observed_mz[0], correction_ratios[0])
+        corrected_mz = self._correct_points_smaller_than(mz_values, observed_mz[0], correction_ratios[0])
 
         #Correct all points between observed_mz[0] and observed_mz[-1]
         index = 0
         while index < len(correction_ratios)-1:
-            corrected_mz += self._correct_point_between(spectrum, observed_mz[index], observed_mz[index+1],
+            corrected_mz += self._correct_point_between(mz_values, observed_mz[index], observed_mz[index+1],
                                                         correction_ratios[index], correction_ratios[index+1])
             index += 1
 
         # Correct the points greater than observed_mz[-1]
-        corrected_mz += self._correct_points_greater_than(spectrum, observed_mz[-1], correction_ratios[-1])
+        corrected_mz += self._correct_points_greater_than(mz_values, observed_mz[-1], correction_ratios[-1])
 
         # Simple verification that we still have the same number of points...
-        if len(corrected_mz) != len(spectrum.mz_values):
+        if len(corrected_mz) != len(mz_values):
             raise ValueError("There should be the same number of mz than in the initial spectrum: %s vs %s"
-                             % (len(corrected_mz), len(spectrum.mz_values)))
+                             % (len(corrected_mz), len(mz_values)))
 
         # Createa copy and return
         spect_copy = copy_spectrum_with_new_mz_and_intensities(spectrum, np.array(corrected_mz),
@@ -190,7 +263,7 @@ class VirtualLockMassCorrector(object):
             o_mz = observed_mz[i]
             if v_mz <= 0 or o_mz <= 0:
                 raise ValueError("Cannot calculate ratio for a null or nagative mz")
-            ratio = np.float(v_mz / o_mz)
+            ratio = np.float64(v_mz / o_mz)
             correction_ratios.append(ratio)
         return correction_ratios
 
@@ -200,8 +273,7 @@ class VirtualLockMassCorrector(object):
         :param spectrum: A pymspec spectrum
         :return: two lists: The vlm found in the spectrum and their correspondance
         """
-        preprocessed_spect = ThresholdedPeakFiltering(threshold=self.minimum_peak_intensity,
-                                                      remove_mz_values=True).fit_transform([spectrum])[0]
+        preprocessed_mz_values = self._thresholded_peaks(spectrum)[0]
         observed_mz = []
         vlm_found = []
         number_skipped_points = 0
@@ -210,7 +282,7 @@ class VirtualLockMassCorrector(object):
             intensity = -1
             last_index = 0
             try:
-                best_match, position = take_closest_lo(preprocessed_spect.mz_values, vlm, lo=last_index)
+                best_match, position = take_closest_lo(preprocessed_mz_values, vlm, lo=last_index)
                 mz_difference = abs(best_match - vlm) # Check if the vlm is in the window.
                 if mz_difference > vlm * self.window_size_ppm: # self.window_size is from center to side, not side to side.
                     raise ValueError("A VLM was not found in the appropriate window")
@@ -229,18 +301,18 @@ class VirtualLockMassCorrector(object):
         np.around(observed_mz, decimals=4)
         return vlm_found, observed_mz
 
-    def _correct_points_smaller_than(self, spectrum, mz, ratio):
+    def _correct_points_smaller_than(self, mz_values, mz, ratio):
         """
         Will apply the correction ratio to every points <mz.
         No modification to correction ratio
-        :param spectrum: the spectrum to correct
+        :param mz_values: the m/z values of the spectrum to correct
         :param mz: the observed mz of the first virtual lock mass
         :param ratio: the correction ratio of the first virtual lock mass
         :return: the corrected mz values of the spectrum, only those inferior to the first virtual lock mass
         """
         if mz <= 0 or ratio <= 0:
             raise ValueError("Mz and ratio cannot be null or negative")
-        mz_list = spectrum.mz_values
+        mz_list = mz_values
         if self.mode == 'flat':
             right = binary_search_for_right_range(mz_list, mz)
             mz_to_be_corrected = mz_list[:right]
@@ -249,16 +321,16 @@ class VirtualLockMassCorrector(object):
             raise NotImplementedError("Use flat mode.")
         return corrected_mz.tolist()
 
-    def _correct_points_greater_than(self, spectrum, mz, ratio):
+    def _correct_points_greater_than(self, mz_values, mz, ratio):
         """
-        :param spectrum: the spectrim to correct
+        :param mz_values: the m/z values of the spectrum to correct
         :param mz: the observed mz of the last virtual lock mass
         :param ratio: the correction ratio of the last virtual lock mass
         :return: the corrected mz values of the spectrum, only those superior to the last virtual lock mass
         """
         if mz <= 0 or ratio <= 0:
             raise ValueError("Mz and ratio cannot be null or negative")
-        mz_list = spectrum.mz_values
+        mz_list = mz_values
         if self.mode == 'flat':
             left = binary_search_for_right_range(mz_list, mz)
             mz_to_be_corrected = mz_list[left:]
@@ -268,9 +340,9 @@ class VirtualLockMassCorrector(object):
         return corrected_mz.tolist()
 
 
-    def _correct_point_between(self, spectrum, mz1, mz2, ratio1, ratio2):
+    def _correct_point_between(self, mz_values, mz1, mz2, ratio1, ratio2):
         """
-        :param spectrum: the spectrum to correct
+        :param mz_values: the m/z values of the spectrum to correct
         :param mz1: an observed mz of a virtual lock mass (smaller than the 2nd)
         :param mz2: an observed mz of a virtual lock mass (greater than the first)
         :param ratio1: correction ratio of mz1
@@ -281,7 +353,7 @@ class VirtualLockMassCorrector(object):
             raise ValueError("Mz and ratios cannot be null or negative")
         function = self._create_correction_function(mz1, mz2, ratio1, ratio2)
 
-        mz_list =spectrum.mz_values
+        mz_list = mz_values
         right = binary_search_for_right_range(mz_list, mz2)
         left = binary_search_for_left_range(mz_list, mz1)
         mz_to_be_corrected = mz_list[left:right]
@@ -316,13 +388,143 @@ class VirtualLockMassCorrector(object):
             function = np.poly1d(z)
         return function
 
-    def fit(self, spectra):
+    def fit(self, spectra, n_jobs=1):
         """
-        TODO
+        Find the VLMs of a set of spectra.
+        :param spectra: The training spectra
+        :param n_jobs: The number of processes used to search the VLMs, each one in a different m/z range. None=one per
+                       CPU.
+        """
+        self._vlm_mz = self._find_vlm_peaks(spectra, n_jobs=n_jobs)
 
+    def fit_approximate(self, spectra, sample_size, random_state=None):
+        """
+        Approximate fit for large sets of spectra. The VLM candidates are found in a random sample of the spectra and
+        are then verified against all the spectra: a candidate is kept if its window contains a group of peaks that
+        fit would accept, i.e. exactly one peak of each spectrum that fit in a window, whose center of mass is valid and
+        whose window does not overlap the window of another VLM that fit would find. The VLMs found are thus always
+        VLMs of fit, and fitting on a sample of all the spectra gives exactly the VLMs of fit.
+        :param spectra: The training spectra
+        :param sample_size: The number of spectra in which the VLM candidates are searched
+        :param random_state: The seed or the np.random.RandomState used for sampling
+        :return: A dict with the number of sampled spectra ("n_sampled_spectra"), of candidates found in the sample
+                 ("n_candidates"), of candidates rejected during the verification ("n_rejected") and of VLMs ("n_vlm")
         """
-        self._vlm_mz = self._find_vlm_peaks(spectra)
+        if not isinstance(random_state, np.random.RandomState):
+            random_state = np.random.RandomState(random_state)
 
+        sample_size = min(sample_size, len(spectra))
+        sample_idx = random_state.choice(len(spectra), size=sample_size, replace=False)
+        sample_spectra_mz_values = self._preprocess_spectra([spectra[i] for i in np.sort(sample_idx)])
+        # The candidates are verified before the overlapping ones are rejected, as in fit
+        candidate_mz = self._compute_vlm_positions(self._find_vlm_peak_groups(sample_spectra_mz_values))
+
+        self._vlm_mz, n_rejected = self._verify_vlm_candidates(candidate_mz, spectra)
+
+        return {"n_sampled_spectra": sample_size,
+                "n_candidates": len(candidate_mz),
+                "n_rejected": n_rejected,
+                "n_vlm": len(self._vlm_mz)}
+
+    def _verify_vlm_candidates(self, candidate_mz, spectra):
+        """
+        Finds the VLMs that fit would find, if it was applied to all the spectra, in the windows of the VLM candidates.
+        A VLM is only kept if its window does not overlap the window of another VLM that fit would find, even if that
+        VLM is not in the window of a candidate.
+        :param candidate_mz: The m/z values of the VLM candidates
+        :param spectra: The spectra
+        :return: The VLMs, sorted in increasing order of m/z, and the number of candidates whose window contains no VLM
+        """
+        n_spectra = len(spectra)
+        w = self.window_size_ppm
+
+        # The VLMs whose window can overlap the window of a VLM found in the window of a candidate have their peaks in
+        # the reach of the candidate. All the groups of peaks in the reach are verified exactly (see below), as long as
+        # the lookup range also contains the peaks that can precede and follow them.
+        reach_starts = candidate_mz * (1 - w)**3 / (1 + w)
+        reach_ends = candidate_mz * (1 + w)**3 / (1 - w)
+        lookup_starts = reach_starts * ((1 - w) / (1 + w))**2
+        lookup_ends = reach_ends * ((1 + w) / (1 - w))**2
+
+        # Gather the peaks of each spectrum around each candidate. The lookups are done on the m/z values of the
+        # spectra and the intensity threshold is only applied to the peaks found, so that the spectra are not filtered
+        # as a whole.
+        peak_candidates = []
+        peak_mz = []
+        peak_spectra = []
+        for spectrum_idx, spectrum in enumerate(spectra):
+            mz_values = spectrum.mz_values
+            starts = np.searchsorted(mz_values, lookup_starts, side="left")
+            counts = np.searchsorted(mz_values, lookup_ends, side="right") - starts
+            peak_idx = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            is_intense = spectrum.intensity_values[peak_idx] > self.minimum_peak_intensity
+            peak_candidates.append(np.repeat(np.arange(len(candidate_mz)), counts)[is_intense])
+            peak_mz.append(mz_values[peak_idx[is_intense]])
+            peak_spectra.append(np.full(np.count_nonzero(is_intense), spectrum_idx))
+
+        if len(candidate_mz) == 0 or n_spectra == 0:
+            return np.array([]), len(candidate_mz)
+        peak_candidates = np.concatenate(peak_candidates)
+        peak_mz = np.concatenate(peak_mz)
+        peak_spectra = np.concatenate(peak_spectra)
+
+        # Sort the peaks by candidate, then by m/z
+        sorter = np.lexsort((peak_mz, peak_candidates))
+        peak_candidates = peak_candidates[sorter]
+        peak_mz = peak_mz[sorter]
+        peak_spectra = peak_spectra[sorter]
+        offsets = np.searchsorted(peak_candidates, np.arange(len(candidate_mz) + 1), side="left")
+
+        # The m/z value of the VLM of each group in the reach of a candidate, None if its center of mass is not valid
+        group_vlm_mz = {}
+        candidate_group_keys = []
+        for candidate_idx, mz in enumerate(candidate_mz):
+            window_mz = peak_mz[offsets[candidate_idx]:offsets[candidate_idx + 1]]
+            window_spectra = peak_spectra[offsets[candidate_idx]:offsets[candidate_idx + 1]]
+            candidate_group_keys.append([])
+            if len(window_mz) < n_spectra:
+                continue
+
+            # Each run of n_spectra consecutive peaks is a possible group. A group is found by _find_vlm_peak_groups if
+            # it does not split peaks with equal m/z, if it fits in a window and if the sweep reaches it, i.e. the peak
+            # that follows the group does not fit in a window with the peak that precedes it. The peaks that are not in
+            # the lookup range are far enough from the groups in the reach to always satisfy these conditions.
+            first_mz = window_mz[:len(window_mz) - n_spectra + 1]
+            last_mz = window_mz[n_spectra - 1:]
+            previous_mz = np.concatenate(([-np.inf], window_mz[:-n_spectra]))
+            next_mz = np.concatenate((window_mz[n_spectra:], [np.inf]))
+            is_group = (first_mz >= reach_starts[candidate_idx]) & (last_mz <= reach_ends[candidate_idx]) & \
+                       (previous_mz < first_mz) & (next_mz > last_mz) & \
+                       ((last_mz / (1 + w)) * (1 - w) <= first_mz) & ((next_mz / (1 + w)) * (1 - w) > previous_mz)
+            is_in_window = (first_mz >= mz * (1 - w)) & (last_mz <= mz * (1 + w))
+
+            for group_start in np.where(is_group)[0]:
+                # Check that the group contains one peak of each spectrum (see is_window_vlm)
+                group_spectra = window_spectra[group_start:group_start + n_spectra]
+                if len(np.unique(group_spectra)) != n_spectra:
+                    continue
+                # A group can be in the reach of several candidates
+                group = window_mz[group_start:group_start + n_spectra]
+                key = (group[0], group[-1])
+                if key not in group_vlm_mz:
+                    vlm_mz = self._compute_vlm_positions([group])
+                    group_vlm_mz[key] = vlm_mz[0] if len(vlm_mz) > 0 else None
+                if is_in_window[group_start]:
+                    candidate_group_keys[-1].append(key)
+
+        # Reject the VLMs whose window overlaps another one, as in fit
+        consistent_vlm_mz = set(self._make_vlm_set_consistent(
+            [group_vlm_mz[key] for key in sorted(group_vlm_mz) if group_vlm_mz[key] is not None]).tolist())
+
+        vlm_mz = set()
+        n_rejected = 0
+        for keys in candidate_group_keys:
+            candidate_vlm_mz = [group_vlm_mz[key] for key in keys if group_vlm_mz[key] in consistent_vlm_mz]
+            if len(candidate_vlm_mz) == 0:
+                n_rejected += 1
+            vlm_mz.update(candidate_vlm_mz)
+
+        return np.array(sorted(vlm_mz)), n_rejected
 
     def transform(self, spectra):
         """
@@ -331,4 +533,56 @@ class VirtualLockMassCorrector(object):
         """
         if self._vlm_mz is None:
             raise RuntimeError("The VLM corrector must be fitted before applying a correction.")
-        return np.asarray([self._apply_correction(spectrum) for spectrum in spectra])
\ No newline at end of file
+        return np.asarray([self._apply_correction(spectrum) for spectrum in spectra])
+
+def vlm_parameter_sweep(spectra, window_sizes, minimum_peak_intensities):
+    """
+    Finds the VLMs of a set of spectra for several window sizes and minimum peak intensities. This is equivalent to
+    fitting a VirtualLockMassCorrector for each combination of parameters, but the peaks of the spectra are
+    concatenated and sorted only once. Each threshold is then applied as a mask on the sorted peaks.
+
+    Parameters
+    ----------
+    spectra: list of Spectrum
+        The training spectra.
+
+    window_sizes: list of float
+        The window sizes (ppm) to try.
+
+    minimum_peak_intensities: list of float
+        The minimum peak intensities to try.
+
+    Returns
+    -------
+    results: list of dict
+        One dict per combination of parameters, with the keys "window_size", "minimum_peak_intensity", "n_vlm" (the
+        number of VLMs) and "vlm_mz" (the m/z values of the VLMs).
+    """
+    peaks = np.concatenate(list(s.mz_values for s in spectra))
+    intensities = np.concatenate(list(s.intensity_values for s in spectra))
+    spectrum_by_peak = np.concatenate(list(np.ones(len(s), dtype=np.uint) * i for i, s in enumerate(spectra)))
+
+    sorter = np.argsort(peaks)
+    peaks = peaks[sorter]
+    intensities = intensities[sorter]
+    spectrum_by_peak = spectrum_by_peak[sorter]
+
+    results = []
+    for minimum_peak_intensity in minimum_peak_intensities:
+        # Masking preserves the order of the peaks, so they do not need to be sorted again
+        keep_mask = intensities > minimum_peak_intensity
+        threshold_peaks = peaks[keep_mask]
+        threshold_spectrum_by_peak = spectrum_by_peak[keep_mask]
+        last_equal_peak_idx = np.searchsorted(threshold_peaks, threshold_peaks, side="right") - 1
+
+        for window_size in window_sizes:
+            corrector = VirtualLockMassCorrector(window_size=window_size,
+                                                 minimum_peak_intensity=minimum_peak_intensity)
+            peak_groups = corrector._find_vlm_peak_groups_in_sorted_peaks(threshold_peaks, threshold_spectrum_by_peak,
+                                                                          len(spectra), last_equal_peak_idx)
+            vlm_mz_values = corrector._vlm_peaks_from_groups(peak_groups)
+            results.append({"window_size": window_size,
+                            "minimum_peak_intensity": minimum_peak_intensity,
+                            "n_vlm": len(vlm_mz_values),
+                            "vlm_mz": vlm_mz_values})
+    return results